@@ -0,0 +1,74 @@
+import argparse
+import json
+import time
+from os.path import join
+import numpy as np
+from components.stt import Stt
+from components.utterances import load_utterances
+
+# real time factor of the Stt backends on this machine, lower is faster:
+# python bench_stt.py --backends torch torch_int8 onnx --device cpu --wav recordings/
+
+
+def load_config(config_file):
+    with open(config_file, "r") as file:
+        json_data = json.load(file)
+    return json_data
+
+
+def bench(stt, utterances, repeats):
+    # the first call warms up kernels and caches, it isn't counted
+    stt.transcribe_translate(utterances[0])
+    audio_sec = 0
+    elapsed = 0
+    transcripts = []
+    for _ in range(repeats):
+        transcripts = []
+        for utterance in utterances:
+            start = time.perf_counter()
+            transcripts.append(stt.transcribe_translate(utterance))
+            elapsed += time.perf_counter() - start
+            audio_sec += len(utterance) / stt.samplerate
+    return elapsed / audio_sec, transcripts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aria STT backend benchmark.")
+    parser.add_argument(
+        "--config",
+        default="default.json",
+        help="Path to JSON config file in the configs folder",
+    )
+    parser.add_argument(
+        "--backends", nargs="+", default=["torch", "torch_int8"], help="Stt backends to compare"
+    )
+    parser.add_argument("--device", help="Device of the torch backend, default from the config")
+    parser.add_argument("--wav", nargs="*", default=[], help="Wav files or folders to transcribe")
+    parser.add_argument("--repeats", type=int, default=3, help="Passes over the recordings")
+    args = parser.parse_args()
+
+    config = load_config(join("configs", args.config))
+    stt_params = config.get("Stt", {}).get("params", {})
+    if args.device:
+        stt_params = {**stt_params, "device": args.device}
+
+    results = {}
+    for backend in args.backends:
+        start = time.perf_counter()
+        stt = Stt(params={**stt_params, "backend": backend})
+        load_sec = time.perf_counter() - start
+        utterances = [
+            np.frombuffer(utterance, np.int16).astype(np.float32) / 32768
+            for utterance in load_utterances(args.wav, stt.samplerate)
+        ]
+        rtf, transcripts = bench(stt, utterances, args.repeats)
+        results[backend] = rtf
+        print(f"{backend}: loaded in {load_sec:.1f} s, real time factor {rtf:.3f}")
+        for transcript in transcripts:
+            print("   ", transcript)
+        del stt
+
+    baseline = results.get(args.backends[0])
+    print(f"{'backend':<12}{'rtf':>8}{'speedup':>10}")
+    for backend, rtf in results.items():
+        print(f"{backend:<12}{rtf:>8.3f}{baseline / rtf:>9.2f}x")
@@ -1,12 +1,27 @@
 import argparse
 import json
 import time
+import queue
 import threading
-from copy import deepcopy
 from os.path import join
 import numpy as np
 from components.nw import Nw
-from components.vad import Vad
+from components.nw import OP_PONG
+from components.nw import OP_PROBE
+from components.nw import OP_AUDIO_CONFIG
+from components.nw import OP_UDP_OFFER
+from components.nw import OP_UDP_READY
+from components.nw import OP_STT_TRANSCRIBE
+from components.nw import OP_STT_RESULT
+from components.nw import OP_LLM_ANSWER
+from components.nw import OP_LLM_TOKEN
+from components.nw import OP_STREAMING_END
+from components.nw import OP_TTS_AUDIO
+from components.nw import OP_TTS_END
+from components.nw import OP_MIC_STREAM_START
+from components.nw import OP_VAD_END
+from components.nw import OP_STT_PARTIAL
+from components.nw import FLAG_AUTO_ANSWER
 from components.ap import Ap
 from components.mic import Mic
 from components.login_ui import LoginUi
@@ -22,151 +37,191 @@ def load_config(config_file):
     return json_data
 
 
+def receive_frames(nw, ap, events, vad_end):
+    # reads and decodes on its own thread so playback never waits on the ui,
+    # audio goes straight into the jitter buffer, the server's end of speech
+    # to vad_end, everything else to events
+    while True:
+        try:
+            opcode, flags, payload = nw.receive_frame()
+        except (OSError, ConnectionError):
+            events.put((None, None))
+            # a thin client waiting for the end of speech goes on to see it
+            vad_end.set()
+            return
+        if opcode == OP_PONG:
+            nw.handle_pong(payload)
+        elif opcode == OP_PROBE:
+            nw.handle_probe(payload)
+        elif opcode == OP_AUDIO_CONFIG:
+            nw.handle_audio_config(payload)
+        elif opcode == OP_UDP_OFFER:
+            nw.start_datagrams(
+                payload,
+                lambda tts_chunk: ap.stream_sound(
+                    np.frombuffer(tts_chunk, np.int16), update_ui=True
+                ),
+            )
+        elif opcode == OP_UDP_READY:
+            nw.udp_ready = True
+        elif opcode == OP_VAD_END:
+            vad_end.set()
+        elif opcode == OP_TTS_AUDIO:
+            tts_chunk = nw.decode_audio(payload)
+            ap.stream_sound(np.frombuffer(tts_chunk, np.int16), update_ui=True)
+        elif opcode == OP_LLM_TOKEN:
+            llm_chunk, color_code_block = nw.unpack_token(payload, flags)
+            if len(llm_chunk) > 0:
+                events.put((opcode, (llm_chunk, color_code_block)))
+        elif opcode == OP_STT_PARTIAL:
+            print("\r🎙...", str(payload, "utf-8"), end="", flush=True)
+        elif opcode in (OP_STT_RESULT, OP_LLM_ANSWER):
+            events.put((opcode, str(payload, "utf-8")))
+        elif opcode == OP_TTS_END:
+            # the turn's audio must be queued before playback is drained
+            nw.finish_datagrams(payload)
+            events.put((opcode, None))
+        else:
+            events.put((opcode, None))
+
+
+def receive_turn(events, ui, ap, llm_params):
+    opcode, stt_data = events.get()
+    if opcode is None:
+        print("Connection lost!")
+        return
+    if len(stt_data) != 1:
+        ui.add_message("You", stt_data, new_entry=True)
+        if not llm_params.get("streaming_output", None):
+            opcode, llm_data = events.get()
+            if opcode is None:
+                print("Connection lost!")
+                return
+            code_blocks = find_code_blocks(llm_data)
+            if len(code_blocks) > 0:
+                color_code_block = True
+            else:
+                color_code_block = False
+            ui.add_message(
+                "Aria",
+                llm_data,
+                new_entry=True,
+                color_code_block=color_code_block,
+                code_blocks=code_blocks,
+            )
+            while True:
+                opcode, data = events.get()
+                if opcode == OP_TTS_END or opcode is None:
+                    break
+            ap.check_audio_finished()
+        else:
+            ui.add_message("Aria", "", new_entry=True)
+            while True:
+                opcode, data = events.get()
+                if opcode == OP_LLM_TOKEN:
+                    llm_chunk, color_code_block = data
+                    ui.add_message(
+                        "Aria",
+                        llm_chunk,
+                        new_entry=False,
+                        color_code_block=color_code_block,
+                    )
+                elif opcode == OP_STREAMING_END or opcode is None:
+                    break
+            ap.check_audio_finished()
+        print("Playback:", ap.jitter_buffer.stats())
+    else:
+        # TODO add to llm context
+        ui.add_message("You", "...", new_entry=True)
+        # nw.send_frame(OP_FIXED_ANSWER)
+        # ui.add_message("Aria", "Did you say something?", new_entry=True)
+        # while True:
+        #     opcode, data = events.get()
+        #     if opcode == OP_TTS_END:
+        #         break
+        # ap.check_audio_finished()
+
+
 def main(nw, ui, mic, vad, ap, llm_params):    
     ap.play_sound(ap.listening_sound)
     ui.load_visual("You")
 
+    events = queue.Queue()
+    vad_end = threading.Event()
+    threading.Thread(
+        target=receive_frames, args=(nw, ap, events, vad_end), daemon=True
+    ).start()
+
     mic_muted = False
-    mic_last_chunk = None
     mic.start_mic()
+    if nw.thin_client:
+        # no local vad, the server detects the end of speech on the streamed mic
+        nw.send_frame(OP_MIC_STREAM_START)
 
     while True:
-        skip_sleep = False
         if ui.kill:
             print("Shutting down...")
+            if vad is not None:
+                print("VAD gate:", vad.gate_stats())
+            print("Mic dropped frames:", mic.dropped_frames)
+            nw.send_bye()
             nw.close_connection()
             break
-        mic_chunk = mic.get_chunk()
-        if len(mic_chunk) == mic.buffer_size * 2:  # 2 bytes per sample when pcm16
-            if max(mic_chunk) == 0 and not mic_muted:
+        nw.send_heartbeat()
+        # blocks until the mic callback hands over the next buffer
+        mic_frame = mic.get_frame(timeout=0.1)
+        if mic_frame is None:
+            continue
+        mic_chunk, mic_samples = mic_frame
+        if not np.any(mic_samples):
+            # every muted frame, or a long mute fills the recording with zeros
+            mic.reset_recording()
+            if not mic_muted:
                 mic_muted = True
                 mic.update_ui = False
                 ui.load_visual("system_muted_mic")
-                vad.reset_vad()
-                mic.reset_recording()
-                skip_sleep = True
-            elif not (
-                mic_chunk == mic_last_chunk
-            ):  # .all() and max(mic_chunk) != 0: TODO
-                if mic_muted:
-                    ui.load_visual("You")
-                    mic.update_ui = True
-                    mic_muted = False
-                mic_last_chunk = deepcopy(mic_chunk)
-                mic.vad_time = vad.no_voice_wait_sec - vad.no_voice_sec
-                chunk_time = mic.buffer_size / mic.samplerate
-                vad_status = vad.check(
-                    np.frombuffer(mic_chunk, np.int16)
-                    .flatten()
-                    .astype(np.float32, order="C")
-                    / 32768.0,
-                    chunk_time,
-                )
-                # print(vad_status, vad.no_voice_sec)
-                if vad_status == "None":
-                    mic.reset_recording()
-                    skip_sleep = True
-                elif vad_status == "vad_end":
-                    mic.stop_mic()
-                    ui.load_visual("system_transition")
-                    ap.play_sound(ap.transition_sound)
-                    mic_recording = mic.get_recording()
-                    vad_no_voice_wait_sec = vad_params.get("no_voice_wait_sec", None)
-                    mic_recording = mic_recording[
-                        : -vad_no_voice_wait_sec
-                        * (mic.samplerate * 2)  # 2 bytes per sample when pcm16
-                    ]
-                    # wf.write('test.wav', mic.samplerate, np.frombuffer(mic_recording, np.int16).flatten())
-                    nw.send_msg("stt_transcribe")
-                    nw.receive_ack()
-                    nw.send_audio_recording(mic_recording)
-                    stt_data = nw.receive_msg()
-                    if len(stt_data) != 1:
-                        ui.add_message("You", stt_data, new_entry=True)
-                        nw.send_msg("llm_get_answer")
-                        if not llm_params.get("streaming_output", None):
-                            llm_data = nw.receive_msg()
-                            code_blocks = find_code_blocks(llm_data)
-                            if len(code_blocks) > 0:
-                                color_code_block = True
-                            else:
-                                color_code_block = False
-                            ui.add_message(
-                                "Aria",
-                                llm_data,
-                                new_entry=True,
-                                color_code_block=color_code_block,
-                                code_blocks=code_blocks,
-                            )
-                            while True:
-                                check_tts = nw.receive_msg()
-                                if check_tts == "tts_end":
-                                    break
-                                else:
-                                    tts_chunk = nw.receive_audio_recording()
-                                    ap.stream_sound(
-                                        np.frombuffer(tts_chunk, np.int16).flatten(),
-                                        update_ui=True,
-                                    )
-                            ap.check_audio_finished()
-                        else:
-                            nw.receive_ack()
-                            ui.add_message("Aria", "", new_entry=True)
-                            while True:
-                                llm_or_tts = nw.receive_msg()
-                                if llm_or_tts == "llm":
-                                    llm_chunk = nw.receive_msg()
-                                    color_code_block = nw.receive_msg()
-                                    ui.add_message(
-                                        "Aria",
-                                        llm_chunk,
-                                        new_entry=False,
-                                        color_code_block=color_code_block.lower()
-                                        == "true",
-                                    )
-                                elif llm_or_tts == "tts":
-                                    while True:
-                                        check_tts = nw.receive_msg()
-                                        if check_tts == "tts_end":
-                                            break
-                                        else:
-                                            tts_chunk = nw.receive_audio_recording()
-                                            ap.stream_sound(
-                                                np.frombuffer(
-                                                    tts_chunk, np.int16
-                                                ).flatten(),
-                                                update_ui=True,
-                                            )
-                                elif llm_or_tts == "streaming_end":
-                                    break
-                            ap.check_audio_finished()
-                    else:
-                        # TODO add to llm context
-                        ui.add_message("You", "...", new_entry=True)
-                        # nw.send_msg("fixed_answer")
-                        # ui.add_message("Aria", "Did you say something?", new_entry=True)
-                        # while True:
-                        #     check_tts = nw.receive_msg()
-                        #     if check_tts == "tts_end":
-                        #         break
-                        #     else:
-                        #         tts_chunk = nw.receive_audio_recording()
-                        #         ap.stream_sound(
-                        #             np.frombuffer(tts_chunk, np.int16).flatten(),
-                        #             update_ui=True,
-                        #         )
-                        # ap.check_audio_finished()
-                    time.sleep(1)
-                    ap.play_sound(ap.listening_sound)
-                    ui.load_visual("You")
-                    mic.start_mic()
-                    skip_sleep = True
-                else:
-                    pass
-            else:
-                pass
-        if not skip_sleep:
-            time.sleep(mic.buffer_size / mic.samplerate)              
+                if not nw.thin_client:
+                    vad.reset_vad()
+            continue
+        if mic_muted:
+            ui.load_visual("You")
+            mic.update_ui = True
+            mic_muted = False
+        if nw.thin_client:
+            nw.send_audio_chunk(mic_chunk)
+            mic.reset_recording()
+            vad_status = "vad_continue"
+            if vad_end.is_set():
+                vad_end.clear()
+                vad_status = "vad_end"
+        else:
+            mic.vad_time = vad.hangover_sec - vad.no_voice_sec
+            vad_status = vad.check(mic_samples)
+        # print(vad_status, vad.no_voice_sec)
+        if vad_status == "None":
+            mic.reset_recording()
+        elif vad_status == "vad_end":
+            mic.stop_mic()
+            ui.load_visual("system_transition")
+            ap.play_sound(ap.transition_sound)
+            if not nw.thin_client:
+                mic_recording = mic.get_recording()
+                mic_recording = mic_recording[
+                    : max(len(mic_recording) - int(vad.end_silence_sec * mic.samplerate), 0)
+                ].tobytes()
+                # wf.write('test.wav', mic.samplerate, np.frombuffer(mic_recording, np.int16).flatten())
+                # the answer is requested together with the transcription
+                nw.send_frame(OP_STT_TRANSCRIBE, flags=FLAG_AUTO_ANSWER)
+                nw.send_audio_recording(mic_recording)
+            receive_turn(events, ui, ap, llm_params)
+            if nw.udp_con is not None:
+                print("Datagrams:", nw.datagram_stats())
+            time.sleep(1)
+            ap.play_sound(ap.listening_sound)
+            ui.load_visual("You")
+            mic.start_mic()
+            if nw.thin_client:
+                nw.send_frame(OP_MIC_STREAM_START)
 
 
 if __name__ == "__main__":
@@ -210,6 +265,8 @@ if __name__ == "__main__":
                 loginui.set_status_message("Connection failed!\nCheck IP and port!", is_error=True)
             elif con_result == "socket_error":
                 loginui.set_status_message("Connection failed!\nCheck IP and port!", is_error=True)
+            elif con_result == "protocol_mismatch":
+                loginui.set_status_message("Connection failed!\nClient and server versions differ!", is_error=True)
             elif con_result == "authentication_failed":
                 loginui.set_status_message("Authentication failed!\nCheck username and password!", is_error=True)
         
@@ -219,7 +276,12 @@ if __name__ == "__main__":
     connection_status = loginui.start()
     
     if connection_status:
-        vad = Vad(params=vad_params)
+        if nw.thin_client:
+            vad = None
+        else:
+            # torch is only needed when the vad runs on the client
+            from components.vad import Vad
+            vad = Vad(params=vad_params)
         ui = Ui(params=ui_params)
         ap = Ap(params=ap_params, ui=ui)
         mic = Mic(params=mic_params, ui=ui, vad=vad)
@@ -0,0 +1,67 @@
+import queue
+import threading
+
+
+class AnswerSender:
+    # sends the tokens of an answer and synthesizes its sentences on threads of
+    # the connection, so the llm lock only covers generation: a slow client
+    # socket or a busy tts holds back this session, not the other ones. Text
+    # and audio have a thread each, tokens never wait for a sentence's audio
+    def __init__(self, nw, tts):
+        self.nw = nw
+        self.tts = tts
+        self.streaming_end = False
+        self.text_outbox = queue.Queue()
+        self.tts_outbox = queue.Queue()
+        self.threads = [
+            threading.Thread(target=self._send_text, daemon=True),
+            threading.Thread(target=self._run_tts, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def send_token(self, text, color_code_block):
+        self.text_outbox.put((text, color_code_block))
+
+    def run_tts(self, text):
+        self.tts_outbox.put(text)
+
+    def send_streaming_end(self):
+        # sent by close, after the last sentence's audio
+        self.streaming_end = True
+
+    def connected(self):
+        # False once a send failed, generating the rest is pointless
+        return all(thread.is_alive() for thread in self.threads)
+
+    def close(self):
+        # returns when everything queued is sent
+        self.text_outbox.put(None)
+        self.tts_outbox.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.streaming_end:
+            self.nw.send_streaming_end()
+
+    def _send_text(self):
+        # tokens are coalesced for token_coalesce_ms (Nw.send_token), the
+        # pending ones go out when that window closes even if none follows
+        timeout = None
+        while True:
+            try:
+                item = self.text_outbox.get(timeout=timeout)
+            except queue.Empty:
+                self.nw.flush_tokens()
+                timeout = None
+                continue
+            if item is None:
+                return
+            self.nw.send_token(*item)
+            timeout = self.nw.coalesce_remaining()
+
+    def _run_tts(self):
+        while True:
+            text = self.tts_outbox.get()
+            if text is None:
+                return
+            self.tts.run_tts(self.nw, text)
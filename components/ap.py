@@ -2,6 +2,7 @@ import time
 import pyaudio
 import numpy as np
 import soundfile as sf
+from .jitter_buffer import JitterBuffer
 
 
 class Ap:
@@ -11,6 +12,8 @@ class Ap:
         self.samplerate = self.params.get("samplerate", None)
         self.buffer_size = self.params.get("buffer_size", None)
         self.channels = self.params.get("channels", None)
+        self.jitter_target_ms = self.params.get("jitter_target_ms", None) or 0
+        self.jitter_max_ms = self.params.get("jitter_max_ms", None) or 60000
         self.listening_sound_path = self.params.get("assets", None).get(
             "listening_sound", None
         )
@@ -25,7 +28,9 @@ class Ap:
         self.ui = ui
         self.update_ui = False
         self.load_visual_once = True
-        self.audio_buffer = None
+        self.jitter_buffer = JitterBuffer(
+            self.samplerate, self.jitter_target_ms, self.jitter_max_ms
+        )
 
         p = pyaudio.PyAudio()
         self.stream = p.open(
@@ -46,24 +51,15 @@ class Ap:
         )
 
     def _callback(self, in_data, frame_count, time_info, status):
-        if self.audio_buffer is None:
-            data = np.zeros(frame_count, dtype=np.int16)
-        elif len(self.audio_buffer) >= frame_count:
-            data = self.audio_buffer[:frame_count]
-            self.audio_buffer = self.audio_buffer[frame_count:]
-        else:
-            shortfall = frame_count - len(self.audio_buffer)
-            data = np.concatenate(
-                (self.audio_buffer, np.zeros(shortfall, dtype=np.int16))
-            )
-            self.audio_buffer = None
+        data = self.jitter_buffer.read(frame_count)
         if self.update_ui:
             self.ui.update_visual("Aria", data.astype(np.float32, order="C") / 32768.0)
         return (data.tobytes(), pyaudio.paContinue)
 
     def check_audio_finished(self):
-        if self.audio_buffer is not None:
-            time.sleep(len(self.audio_buffer) / self.samplerate)
+        self.jitter_buffer.drain()
+        while self.jitter_buffer.available() > 0:
+            time.sleep(self.jitter_buffer.available() / self.samplerate)
         self.update_ui = False
         self.load_visual_once = True
 
@@ -72,10 +68,7 @@ class Ap:
             self.ui.load_visual("Aria")
             self.load_visual_once = False
         self.update_ui = update_ui
-        if self.audio_buffer is None:
-            self.audio_buffer = chunk
-        else:
-            self.audio_buffer = np.concatenate((self.audio_buffer, chunk))
+        self.jitter_buffer.write(chunk)
 
     def play_sound(self, sound):
         for chunk_index in range(0, len(sound), self.buffer_size):
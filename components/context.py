@@ -0,0 +1,111 @@
+import re
+
+# chat template tokens around each message (role header, end of turn)
+MESSAGE_OVERHEAD_TOKENS = 8
+COLLAPSED_CODE_BLOCK = "```(code omitted)```"
+
+
+class Context:
+    # the chat history sent to the llm, kept within context_length minus
+    # reply_tokens. Each message is tokenized once, when it is added. Over the
+    # budget, the code blocks of older answers are collapsed first, then the
+    # oldest turns dropped; the system prompt and pinned messages always stay,
+    # and so does the newest message. Shrinking goes down to context_low_water
+    # of the budget, so the kept prefix (and llama.cpp's cache of it) then
+    # stays the same for a while instead of changing every turn.
+    def __init__(self, system_message, count_tokens, params=None):
+        self.params = params or {}
+        self.context_length = self.params.get("context_length", None)
+        self.reply_tokens = self.params.get("reply_tokens", None) or 1024
+        self.low_water = self.params.get("context_low_water", None) or 0.75
+        self.collapse_code_blocks = self.params.get("collapse_code_blocks", None)
+        self.count_tokens = count_tokens
+        self.budget = self.context_length - self.reply_tokens
+        self.system_message = system_message
+        self.dropped_messages = 0
+        self.reset()
+
+    def reset(self):
+        self.messages = []
+        self.token_counts = []
+        self.pinned = []
+        self.tokens = 0
+        self.summary = None
+        self.append("system", self.system_message, pinned=True)
+
+    def append(self, role, content, pinned=False):
+        self.messages.append({"role": role, "content": content})
+        self.token_counts.append(self.count_tokens(content) + MESSAGE_OVERHEAD_TOKENS)
+        self.pinned.append(pinned)
+        self.tokens += self.token_counts[-1]
+        if self.tokens > self.budget:
+            self._shrink()
+
+    def _replace(self, index, content):
+        self.messages[index] = {"role": self.messages[index]["role"], "content": content}
+        self.tokens -= self.token_counts[index]
+        self.token_counts[index] = self.count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        self.tokens += self.token_counts[index]
+
+    def _remove(self, index):
+        del self.messages[index]
+        self.tokens -= self.token_counts.pop(index)
+        self.pinned.pop(index)
+
+    def turns(self):
+        return sum(1 for message in self.messages[1:] if message["role"] == "user")
+
+    def summarizable(self, keep_turns):
+        # indices of the messages before the last keep_turns turns, summary excluded
+        unpinned = [index for index, pinned in enumerate(self.pinned) if not pinned]
+        return unpinned[: max(len(unpinned) - 2 * keep_turns, 0)]
+
+    def summarize(self, indices, summary):
+        # the messages at indices are replaced by one pinned message right after
+        # the system prompt, which also replaces the previous summary
+        for index in reversed(indices):
+            self._remove(index)
+        content = "Summary of the earlier conversation: " + summary
+        if self.summary is not None:
+            self._replace(1, content)
+        else:
+            self.messages.insert(1, {"role": "system", "content": content})
+            self.token_counts.insert(1, self.count_tokens(content) + MESSAGE_OVERHEAD_TOKENS)
+            self.pinned.insert(1, True)
+            self.tokens += self.token_counts[1]
+        self.summary = summary
+
+    def _shrink(self):
+        target = self.budget * self.low_water
+        tokens = self.tokens
+        if self.collapse_code_blocks:
+            for index in range(len(self.messages) - 1):
+                if self.tokens <= target:
+                    break
+                message = self.messages[index]
+                if self.pinned[index] or message["role"] != "assistant":
+                    continue
+                collapsed = re.sub(
+                    r"```.*?```", COLLAPSED_CODE_BLOCK, message["content"], flags=re.DOTALL
+                )
+                if collapsed != message["content"]:
+                    self._replace(index, collapsed)
+        index = 0
+        while self.tokens > target and index < len(self.messages) - 1:
+            if self.pinned[index]:
+                index += 1
+                continue
+            self._remove(index)
+            self.dropped_messages += 1
+            # an answer goes with its question
+            while (
+                index < len(self.messages) - 1
+                and not self.pinned[index]
+                and self.messages[index]["role"] == "assistant"
+            ):
+                self._remove(index)
+                self.dropped_messages += 1
+        print(
+            f"Context: {tokens} tokens over the budget of {self.budget},"
+            f" shrunk to {self.tokens}, {self.dropped_messages} messages dropped so far"
+        )
@@ -0,0 +1,87 @@
+import threading
+import numpy as np
+
+
+class JitterBuffer:
+    def __init__(self, samplerate, target_ms=0, max_ms=60000):
+        self.samplerate = samplerate
+        self.target_samples = int(samplerate * target_ms / 1000)
+        self.capacity = max(int(samplerate * max_ms / 1000), self.target_samples, 1)
+        self._buffer = np.zeros(self.capacity, dtype=np.int16)
+        self._read_pos = 0
+        self._level = 0
+        self._lock = threading.Lock()
+        # hold playback until target_samples are queued, so a late packet
+        # doesn't immediately turn into a gap
+        self._playing = False
+        self._draining = False
+        self.underruns = 0
+        self.overruns = 0
+        self.padded_samples = 0
+        self.dropped_samples = 0
+
+    def available(self):
+        return self._level
+
+    def write(self, samples):
+        with self._lock:
+            overflow = self._level + len(samples) - self.capacity
+            if overflow > 0:
+                # drop the oldest audio rather than grow without bound
+                self.overruns += 1
+                self.dropped_samples += overflow
+                if len(samples) > self.capacity:
+                    samples = samples[-self.capacity :]
+                    overflow = self._level
+                self._read_pos = (self._read_pos + overflow) % self.capacity
+                self._level -= overflow
+            write_pos = (self._read_pos + self._level) % self.capacity
+            first = min(len(samples), self.capacity - write_pos)
+            self._buffer[write_pos : write_pos + first] = samples[:first]
+            self._buffer[: len(samples) - first] = samples[first:]
+            self._level += len(samples)
+            self._draining = False
+            if self._level >= self.target_samples:
+                self._playing = True
+
+    def read(self, frame_count):
+        data = np.zeros(frame_count, dtype=np.int16)
+        with self._lock:
+            if self._level == 0 and self._playing and not self._draining:
+                # ran dry right at a packet boundary, same as a partial read
+                self.underruns += 1
+                self.padded_samples += frame_count
+                self._playing = False
+                return data
+            if not (self._playing or self._draining) or self._level == 0:
+                self._draining = False
+                return data
+            n = min(frame_count, self._level)
+            first = min(n, self.capacity - self._read_pos)
+            data[:first] = self._buffer[self._read_pos : self._read_pos + first]
+            data[first:n] = self._buffer[: n - first]
+            self._read_pos = (self._read_pos + n) % self.capacity
+            self._level -= n
+            if n < frame_count:
+                self.padded_samples += frame_count - n
+                if not self._draining:
+                    # ran dry mid stream, rebuild the cushion before resuming
+                    self.underruns += 1
+                    self._playing = False
+                self._draining = False
+        return data
+
+    def drain(self):
+        # the stream is over, play out whatever is left even below target
+        with self._lock:
+            if self._level > 0:
+                self._draining = True
+            self._playing = False
+
+    def stats(self):
+        return {
+            "underruns": self.underruns,
+            "overruns": self.overruns,
+            "padded_ms": int(self.padded_samples * 1000 / self.samplerate),
+            "dropped_ms": int(self.dropped_samples * 1000 / self.samplerate),
+        }
@@ -0,0 +1,73 @@
+import os
+import pickle
+import hashlib
+from collections import OrderedDict
+
+
+def state_bytes(state):
+    # a LlamaState also holds the logits of the last batch (n_batch x n_vocab
+    # float32, about 260 MB with llama-3's vocabulary) and the token ids
+    return state.llama_state_size + state.scores.nbytes + state.input_ids.nbytes
+
+
+class KvStates:
+    # llama.cpp states (Llama.save_state) per user, least recently used last out:
+    # kept in RAM up to max_bytes, then pickled to cache_dir, or dropped without one.
+    # Files outlive the server, so their names also hash namespace (model and
+    # context length): a state is never loaded into a different model
+    def __init__(self, max_bytes, cache_dir=None, namespace=""):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.namespace = namespace
+        self.states = OrderedDict()
+        self.bytes = 0
+        self.spilled = 0
+        self.loaded = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(
+            self.cache_dir,
+            hashlib.sha1(f"{self.namespace}\0{key}".encode("utf-8")).hexdigest() + ".state",
+        )
+
+    def get(self, key):
+        if key in self.states:
+            self.states.move_to_end(key)
+            return self.states[key]
+        if self.cache_dir and os.path.exists(self._path(key)):
+            with open(self._path(key), "rb") as file:
+                state = pickle.load(file)
+            self.loaded += 1
+            self.put(key, state)
+            return state
+        return None
+
+    def put(self, key, state):
+        self.pop(key)
+        self.states[key] = state
+        self.bytes += state_bytes(state)
+        # the newest state stays even when it alone is over the limit
+        while self.bytes > self.max_bytes and len(self.states) > 1:
+            old_key, old_state = self.states.popitem(last=False)
+            self.bytes -= state_bytes(old_state)
+            if self.cache_dir:
+                with open(self._path(old_key), "wb") as file:
+                    pickle.dump(old_state, file)
+                self.spilled += 1
+
+    def pop(self, key):
+        state = self.states.pop(key, None)
+        if state is not None:
+            self.bytes -= state_bytes(state)
+        if self.cache_dir and os.path.exists(self._path(key)):
+            os.remove(self._path(key))
+
+    def stats(self):
+        return {
+            "users_in_ram": len(self.states),
+            "ram_mb": round(self.bytes / 2**20, 1),
+            "spilled": self.spilled,
+            "loaded_from_disk": self.loaded,
+        }
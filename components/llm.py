@@ -1,6 +1,9 @@
 import sys
+import threading
 from llama_cpp import Llama
 from huggingface_hub import hf_hub_download
+from .context import Context
+from .summarizer import Summarizer
 from .utils import remove_emojis
 from .utils import remove_nonverbal_cues
 
@@ -17,6 +20,7 @@ class Llm:
         self.chat_format = self.params.get("chat_format", None)
         self.system_message = self.params.get("system_message", None)
         self.verbose = self.params.get("verbose", None)
+        self.summarize = self.params.get("summarize", None)
 
         if self.custom_path != "":
             model_path = self.custom_path
@@ -34,13 +38,67 @@ class Llm:
             verbose=self.verbose,
         )
 
-        self.messages = [{"role": "system", "content": self.system_message}]
+        self.context = Context(self.system_message, self.count_tokens, params=self.params)
+        # the background summarizer uses the same Llama instance between turns
+        self.lock = threading.Lock()
+        self.summarizer = Summarizer(self, params=self.params) if self.summarize else None
+
+    def count_tokens(self, text):
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+    def interrupt_background(self):
+        if self.summarizer is not None:
+            self.summarizer.interrupt()
+
+    def reset(self):
+        self.interrupt_background()
+        with self.lock:
+            self.context.reset()
+
+    def get_context(self, key):
+        return self.context
+
+    def save_cache(self):
+        # the conversation evaluated so far, put back when a summary is cancelled
+        return self.llm.save_state()
+
+    def restore_cache(self, saved):
+        self.llm.load_state(saved)
+
+    def evaluate(self, prompts, cancelled):
+        # each prompt extends the previous one, llama.cpp only evaluates what is
+        # new; False when cancelled between two of them
+        for messages in prompts:
+            if cancelled():
+                return False
+            self.llm.create_chat_completion(messages, max_tokens=1)
+        return True
+
+    def generate_summary(self, messages, max_tokens):
+        for out in self.llm.create_chat_completion(
+            messages, max_tokens=max_tokens, stream=True
+        ):
+            yield out["choices"][0]["delta"].get("content", "")
+
+    def prefill(self, key, prompts, cancelled):
+        # evaluates the prompt now, the next turn reuses it as its prefix
+        return self.evaluate(prompts, cancelled)
 
     def get_answer(self, ui, ap, tts, data):
-        self.messages.append({"role": "user", "content": data})
+        self.interrupt_background()
+        with self.lock:
+            llm_output = self._get_answer(ui, ap, tts, data)
+        if self.summarizer is not None:
+            self.summarizer.turn_finished(None)
+        return llm_output
+
+    def _get_answer(self, ui, ap, tts, data):
+        self.context.append("user", data)
 
         outputs = self.llm.create_chat_completion(
-            self.messages, stream=self.streaming_output
+            self.context.messages,
+            stream=self.streaming_output,
+            max_tokens=self.context.reply_tokens,
         )
 
         if self.streaming_output:
@@ -112,6 +170,6 @@ class Llm:
         else:
             llm_output = outputs["choices"][0]["message"]["content"].strip()
 
-        self.messages.append({"role": "assistant", "content": llm_output})
+        self.context.append("assistant", llm_output)
 
         return llm_output
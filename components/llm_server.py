@@ -1,5 +1,11 @@
+import threading
+import llama_cpp
 from llama_cpp import Llama
 from huggingface_hub import hf_hub_download
+from .kv_states import KvStates
+from .answer_sender import AnswerSender
+from .context import Context
+from .summarizer import Summarizer
 from .utils import remove_emojis
 from .utils import remove_nonverbal_cues
 
@@ -16,6 +22,11 @@ class Llm:
         self.chat_format = self.params.get("chat_format", None)
         self.system_message = self.params.get("system_message", None)
         self.verbose = self.params.get("verbose", None)
+        # each user's kv cache is saved after their turn and restored before the
+        # next one, so alternating users don't evaluate their whole history again
+        self.kv_cache_ram_mb = self.params.get("kv_cache_ram_mb", None) or 0
+        self.kv_cache_dir = self.params.get("kv_cache_dir", None)
+        self.summarize = self.params.get("summarize", None)
 
         if self.custom_path != "":
             model_path = self.custom_path
@@ -35,16 +46,124 @@ class Llm:
 
         #self.messages = [{"role": "system", "content": self.system_message}]
         self.user_aware_messages = {}
+        # one Llama instance is shared by every connected client
+        self.lock = threading.Lock()
+
+        self.kv_states = None
+        self.resident_user = None
+        self.prompt_eval_tokens = 0
+        self.turns = 0
+        if self.kv_cache_ram_mb > 0:
+            self.kv_states = KvStates(
+                self.kv_cache_ram_mb * 2**20,
+                self.kv_cache_dir,
+                namespace=f"{model_path}:{self.context_length}",
+            )
+            # the system prompt evaluated once, new and reset users start from it
+            self.llm.create_chat_completion(
+                [{"role": "system", "content": self.system_message}], max_tokens=1
+            )
+            self.system_state = self.llm.save_state()
+        self.summarizer = Summarizer(self, params=self.params) if self.summarize else None
+
+    def count_tokens(self, text):
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+    def interrupt_background(self):
+        if self.summarizer is not None:
+            self.summarizer.interrupt()
+
+    def get_context(self, user):
+        return self.user_aware_messages.get(user, None)
+
+    def save_cache(self):
+        # the cache is about to hold a summary prompt, put back on cancel
+        if self.kv_states is not None:
+            # every user's state is in kv_states, the next turn loads its own
+            self.resident_user = None
+            return None
+        return self.llm.save_state()
+
+    def restore_cache(self, saved):
+        if saved is not None:
+            self.llm.load_state(saved)
+
+    def evaluate(self, prompts, cancelled):
+        # each prompt extends the previous one, llama.cpp only evaluates what is
+        # new; False when cancelled between two of them
+        for messages in prompts:
+            if cancelled():
+                return False
+            self.llm.create_chat_completion(messages, max_tokens=1)
+        return True
+
+    def generate_summary(self, messages, max_tokens):
+        for out in self.llm.create_chat_completion(
+            messages, max_tokens=max_tokens, stream=True
+        ):
+            yield out["choices"][0]["delta"].get("content", "")
+
+    def prefill(self, user, prompts, cancelled):
+        # evaluates the user's prompt now, their next turn reuses it as its
+        # prefix; a cancelled prefill still leaves a prefix of it in the cache
+        done = self.evaluate(prompts, cancelled)
+        if self.kv_states is not None and done:
+            self.kv_states.put(user, self.llm.save_state())
+        self.resident_user = user
+        return done
+
+    def reset(self, user):
+        self.interrupt_background()
+        with self.lock:
+            self.user_aware_messages.pop(user, None)
+            if self.kv_states is not None:
+                self.kv_states.pop(user)
+            if self.resident_user == user:
+                self.resident_user = None
 
     def get_answer(self, nw, tts, data, user):
+        self.interrupt_background()
+        sender = AnswerSender(nw, tts)
+        try:
+            with self.lock:
+                if self.kv_states is not None and self.resident_user != user:
+                    # llama.cpp reuses the longest common prefix with the loaded state
+                    state = self.kv_states.get(user)
+                    self.llm.load_state(state if state is not None else self.system_state)
+                llama_cpp.llama_perf_context_reset(self.llm.ctx)
+                llm_output = self._get_answer(sender, data, user)
+                perf = llama_cpp.llama_perf_context(self.llm.ctx)
+                self.prompt_eval_tokens += perf.n_p_eval
+                self.turns += 1
+                print(
+                    f"LLM prompt eval: {perf.n_p_eval} tokens in {perf.t_p_eval_ms:.0f} ms,"
+                    f" {self.prompt_eval_tokens / self.turns:.0f} per turn on average"
+                )
+                if self.kv_states is not None:
+                    self.kv_states.put(user, self.llm.save_state())
+                    self.resident_user = user
+                    print("LLM kv states:", self.kv_states.stats())
+        finally:
+            # the last sentences are synthesized and sent outside the lock
+            sender.close()
+        if self.summarizer is not None:
+            self.summarizer.turn_finished(user)
+        return llm_output
+
+    def _get_answer(self, sender, data, user):
         #self.messages.append({"role": "user", "content": data})
         if user not in self.user_aware_messages:
-            self.user_aware_messages[user] = [{"role": "system", "content": self.system_message}]
-        self.user_aware_messages[user].append({"role": "user", "content": data})
+            self.user_aware_messages[user] = Context(
+                self.system_message, self.count_tokens, params=self.params
+            )
+        context = self.user_aware_messages[user]
+        context.append("user", data)
 
         outputs = self.llm.create_chat_completion(
             # self.messages, stream=self.streaming_output
-            self.user_aware_messages[user], stream=self.streaming_output
+            context.messages,
+            stream=self.streaming_output,
+            max_tokens=context.reply_tokens,
         )
 
         if self.streaming_output:
@@ -53,8 +172,10 @@ class Llm:
             color_code_block = False
             backticks = 0
             skip_code_block_on_tts = False
-            nw.send_ack()
             for i, out in enumerate(outputs):
+                if not sender.connected():
+                    # the client is gone, stop generating for it
+                    break
                 if "content" in out["choices"][0]["delta"]:
                     output_chunk_txt = out["choices"][0]["delta"]["content"]
                     if (
@@ -69,14 +190,10 @@ class Llm:
                         backticks = 0
                     if i == 1:
                         if backticks == 0:
-                            nw.send_msg("llm")
-                            nw.send_msg(output_chunk_txt.strip())
-                            nw.send_msg(str(color_code_block))
+                            sender.send_token(output_chunk_txt.strip(), color_code_block)
                     else:
                         if backticks == 0:
-                            nw.send_msg("llm")
-                            nw.send_msg(output_chunk_txt)
-                            nw.send_msg(str(color_code_block))
+                            sender.send_token(output_chunk_txt, color_code_block)
                     llm_output += output_chunk_txt
                     if (
                         not skip_code_block_on_tts
@@ -93,22 +210,20 @@ class Llm:
                                 )
                             # TODO fix 1 character
                             if len(txt_for_tts) > 1:
-                                nw.send_msg("tts")
-                                tts.run_tts(nw, txt_for_tts)
+                                sender.run_tts(txt_for_tts)
                             tts_text_buffer = []
             if not skip_code_block_on_tts and len(tts_text_buffer) != 0:
                 # TODO remove multi dots
                 txt_for_tts = remove_nonverbal_cues(remove_emojis("".join(tts_text_buffer).strip()))
                 # TODO fix 1 character
                 if len(txt_for_tts) > 1:
-                    nw.send_msg("tts")
-                    tts.run_tts(nw, txt_for_tts)
-            nw.send_msg("streaming_end")
+                    sender.run_tts(txt_for_tts)
+            sender.send_streaming_end()
             llm_output = llm_output.strip()
         else:
             llm_output = outputs["choices"][0]["message"]["content"].strip()
 
         #self.messages.append({"role": "assistant", "content": llm_output})
-        self.user_aware_messages[user].append({"role": "assistant", "content": llm_output})
+        context.append("assistant", llm_output)
 
         return llm_output
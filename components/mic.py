@@ -1,3 +1,5 @@
+import queue
+import threading
 import numpy as np
 import pyaudio
 
@@ -9,17 +11,22 @@ class Mic:
         self.samplerate = self.params.get("samplerate", None)
         self.buffer_size = self.params.get("buffer_size", None)
         self.channels = self.params.get("channels", None)
+        self.max_utterance_sec = self.params.get("max_utterance_sec", None) or 120
+        self.pre_roll_sec = self.params.get("pre_roll_sec", None) or 1
+        self.queue_frames = self.params.get("queue_frames", None) or 50
         self.sample_format = pyaudio.paInt16
-        self.bytes_per_second = (
-            self.samplerate * 2 * self.channels
-        )  # 2 bytes per sample when pcm16
+        self.pre_roll_samples = int(self.pre_roll_sec * self.samplerate) * self.channels
+        self.capacity = (
+            int(self.max_utterance_sec * self.samplerate) * self.channels
+            + self.pre_roll_samples
+        )
 
         if self.audio_device == "default":
             self.audio_device = None
 
         self.ui = ui
         self.update_ui = False
-        self.vad_time = vad.no_voice_wait_sec
+        self.vad_time = vad.no_voice_wait_sec if vad is not None else 0
 
         p = pyaudio.PyAudio()
         self._stream = p.open(
@@ -33,41 +40,72 @@ class Mic:
             start=False,
         )
 
-        self._chunk_buffer = bytes()
-        self._recording_buffer = bytearray()
+        # every mic buffer goes to the consumer once, dropped when it falls behind
+        self._frames = queue.Queue(maxsize=self.queue_frames)
+        self.dropped_frames = 0
+        # preallocated once: the recording is always at the start of these, in
+        # pcm16 and already converted to float32, so callers get views, not copies
+        self._recording = np.zeros(self.capacity, dtype=np.int16)
+        self._recording_float = np.zeros(self.capacity, dtype=np.float32)
+        self._length = 0
+        self._lock = threading.Lock()
+        self.overflow_samples = 0
 
     def _callback(self, in_data, frame_count, time_info, status):
-        self._chunk_buffer = in_data
-        self._recording_buffer.extend(self._chunk_buffer)
-        # self._recording_buffer.extend(in_data)
+        samples = np.frombuffer(in_data, np.int16)
+        samples_float = samples.astype(np.float32) / 32768.0
+        try:
+            self._frames.put_nowait((in_data, samples_float))
+        except queue.Full:
+            self.dropped_frames += 1
+        with self._lock:
+            start = self._length
+            n_samples = min(len(samples), self.capacity - start)
+            if n_samples < len(samples):
+                # full, the rest of the utterance is dropped instead of growing
+                if self.overflow_samples == 0:
+                    print(f"\nMic: recording longer than {self.max_utterance_sec} s, cut")
+                self.overflow_samples += len(samples) - n_samples
+            self._recording[start : start + n_samples] = samples[:n_samples]
+            self._recording_float[start : start + n_samples] = samples_float[:n_samples]
+            self._length += n_samples
         if self.update_ui:
             self.ui.update_visual(
                 "You",
-                np.frombuffer(self._chunk_buffer, np.int16)
-                .flatten()
-                .astype(np.float32, order="C")
-                / 32768.0,
+                samples_float,
                 time_color_warning=self.vad_time,
             )
-        # return (in_data, pyaudio.paContinue)
-        return (self._chunk_buffer, pyaudio.paContinue)
+        return (in_data, pyaudio.paContinue)
+
+    def get_frame(self, timeout=None):
+        # (pcm16 bytes, float32 samples) of the next mic buffer, None on timeout
+        try:
+            return self._frames.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    # the methods below return views into the live buffers, not copies: the
+    # callback keeps appending after them, and reset_recording or start_mic
+    # overwrite what they show. Copy before keeping one past either call, or
+    # before handing it to code that runs while the mic is on
 
     def get_recording(self):
-        # return np.frombuffer(self._recording_buffer, np.float32).flatten()
-        return bytes(self._recording_buffer)
+        # pcm16 samples
+        return self._recording[: self._length]
+
+    def get_recording_float(self):
+        return self._recording_float[: self._length]
 
-    def get_chunk(self):
-        # return np.frombuffer(self._chunk_buffer, np.float32).flatten()
-        # return np.frombuffer(
-        #     self._recording_buffer[-(self.buffer_size * 4) :], np.float32
-        # ).flatten()
-        # return self._recording_buffer[-(self.buffer_size * 2) :]
-        return self._chunk_buffer
+    def get_recording_from(self, offset):
+        # pcm16 samples from offset on
+        return self._recording[offset : self._length]
 
     def start_mic(self):
         self.update_ui = True
-        self._chunk_buffer = bytes()
-        self._recording_buffer = bytearray()
+        # frames still queued from before the stop are stale
+        self._frames = queue.Queue(maxsize=self.queue_frames)
+        self._length = 0
+        self.overflow_samples = 0
         self._stream.start_stream()
 
     def stop_mic(self):
@@ -75,11 +113,11 @@ class Mic:
         self.update_ui = False
 
     def reset_recording(self):
-        # self._recording_buffer = bytearray()
-        # make sure we keep the last second before reset to avoid losing speech on next run
-        if len(self._recording_buffer) >= self.bytes_per_second:
-            last_second = self._recording_buffer[-self.bytes_per_second :]
-        else:
-            last_second = self._recording_buffer
-        self._recording_buffer = bytearray()
-        self._recording_buffer.extend(last_second)
+        # make sure we keep the pre-roll before reset to avoid losing speech on next run
+        with self._lock:
+            keep = min(self._length, self.pre_roll_samples)
+            start = self._length - keep
+            self._recording[:keep] = self._recording[start : self._length]
+            self._recording_float[:keep] = self._recording_float[start : self._length]
+            self._length = keep
+            self.overflow_samples = 0
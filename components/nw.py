@@ -1,7 +1,63 @@
 # import re
+import os
+import time
+import random
 import struct
 import socket
+import ctypes
+import secrets
+import threading
+from collections import deque
 import opuslib
+from .shm_ring import ShmRing
+
+
+# wire protocol: every frame is opcode (u8), flags (u8), payload length (u32)
+PROTOCOL_VERSION = 5
+FRAME_HEADER = struct.Struct("!BBI")
+
+OP_HELLO = 0x01  # server -> client, payload: protocol version (u16)
+OP_AUTH = 0x02  # client -> server, payload: username \0 password
+OP_AUTH_RESULT = 0x03  # server -> client, FLAG_OK on success, payload: session token
+OP_PING = 0x04  # client -> server, payload: PING; doubles as heartbeat
+OP_PONG = 0x05  # server -> client, payload: echoed send time (f64)
+OP_PROBE = 0x06  # server -> client, filler sized to measure throughput
+OP_AUDIO_CONFIG = 0x07  # server -> client, payload: AUDIO_CONFIG, profile name
+OP_RESUME = 0x08  # client -> server instead of OP_AUTH, payload: RESUME
+OP_RESUME_RESULT = 0x09  # server -> client, FLAG_OK and frames received (u64) on success
+OP_SHM_RING = 0x0A  # unix transport, payload: name of the sender's shared memory ring
+OP_UDP_OFFER = 0x0B  # server -> client, payload: UDP_OFFER
+OP_UDP_READY = 0x0C  # server -> client, the client's registration datagram arrived
+OP_BYE = 0x0D  # client -> server, the session ends here, no resumption
+OP_STT_TRANSCRIBE = 0x10  # client -> server, followed by OP_AUDIO... OP_AUDIO_END
+OP_AUDIO = 0x11  # one opus packet, or raw pcm16 when uncompressed
+OP_AUDIO_END = 0x12
+OP_STT_RESULT = 0x13  # payload: transcript
+OP_MIC_STREAM_START = 0x14  # client -> server, thin client starts listening
+OP_MIC_STREAM = 0x15  # one opus packet, or raw pcm16, of the live mic
+OP_VAD_END = 0x16  # server -> client, followed by OP_STT_RESULT and the answer
+OP_STT_PARTIAL = 0x17  # server -> client, payload: transcript so far while the user speaks
+OP_LLM_GET_ANSWER = 0x20
+OP_LLM_TOKEN = 0x21  # payload: text length (u32), text
+OP_LLM_ANSWER = 0x22  # payload: complete answer when not streaming
+OP_STREAMING_END = 0x23
+OP_FIXED_ANSWER = 0x24
+OP_TTS_AUDIO = 0x30  # one opus packet, or raw pcm16 when uncompressed
+OP_TTS_END = 0x31  # payload: datagrams sent so far (u32) when tts audio goes over udp
+
+FLAG_OK = 0x01
+FLAG_CODE_BLOCK = 0x01
+FLAG_AUTO_ANSWER = 0x01  # on OP_STT_TRANSCRIBE: answer right after transcribing
+FLAG_PROBE = 0x01  # on OP_PING: follow the pong with an OP_PROBE
+FLAG_SHM = 0x80  # any opcode: payload is a REF into the sender's shm ring
+
+TOKEN_LENGTH = struct.Struct("!I")
+PING = struct.Struct("!dff")  # send time, measured rtt ms, measured kbps
+AUDIO_CONFIG = struct.Struct("!IBB")  # bitrate, complexity, frame ms
+SESSION_TOKEN_SIZE = 16
+RESUME = struct.Struct(f"!{SESSION_TOKEN_SIZE}sQ")  # session token, frames received
+UDP_OFFER = struct.Struct("!QH")  # datagram session id, udp port
+DATAGRAM = struct.Struct("!QI")  # datagram session id, sequence number, then one opus packet
 
 
 class Nw:
@@ -13,57 +69,420 @@ class Nw:
         self.passwords_whitelist = self.params.get("passwords_whitelist", None)
         self.client_connect_timeout = self.params.get("client_connect_timeout", None)
         self.audio_compression = self.params.get("audio_compression", None)
+        self.transport = self.params.get("transport", None) or "tcp"
+        self.unix_socket_path = self.params.get("unix_socket_path", None)
+        self.shm_ring_bytes = self.params.get("shm_ring_bytes", None) or 0
+        self.shm_min_bytes = self.params.get("shm_min_bytes", None) or 4096
+        self.udp_audio = self.params.get("udp_audio", None)
+        self.udp_port = self.params.get("udp_port", None)
+        self.udp_reorder_window = self.params.get("udp_reorder_window", None) or 3
+        self.udp_end_wait_ms = self.params.get("udp_end_wait_ms", None) or 200
+        self.udp_loss_rate = self.params.get("udp_loss_rate", None) or 0
+        self.udp_reorder_rate = self.params.get("udp_reorder_rate", None) or 0
+        if self.transport == "unix":
+            # same host, encoding would only cost cpu
+            self.audio_compression = False
+        self.concurrent_server = self.params.get("concurrent_server", None)
+        self.max_clients = self.params.get("max_clients", None)
+        self.auth_timeout_sec = self.params.get("auth_timeout_sec", None)
+        self.idle_timeout_sec = self.params.get("idle_timeout_sec", None)
+        self.heartbeat_interval_sec = self.params.get("heartbeat_interval_sec", None)
+        self.thin_client = self.params.get("thin_client", None)
+        self.recv_buffer_size = self.params.get("recv_buffer_size", None) or 65536
+        self.token_coalesce_ms = self.params.get("token_coalesce_ms", None) or 0
+        self.link_probe_interval_sec = self.params.get("link_probe_interval_sec", None)
+        self.link_probe_bytes = self.params.get("link_probe_bytes", None) or 32768
+        self.audio_profiles = self.params.get("audio_profiles", None) or []
+        self.resume_grace_sec = self.params.get("resume_grace_sec", None)
+        self.resume_buffer_frames = self.params.get("resume_buffer_frames", None) or 4096
+        # raw pcm frames are large, the outbox is bounded in bytes as well
+        self.resume_buffer_bytes = self.params.get("resume_buffer_bytes", None) or 2**24
         self.con = None
+        self.last_send_time = time.time()
+        self.encoder = None
+        self.decoder = None
         self.buffer = bytearray()
         self.data_remaining = bytearray()
+        # frames are parsed out of one reusable receive buffer, decoded audio
+        # is written into one reusable pcm buffer; views handed out by the
+        # receive_* methods stay valid until the next receive call
+        self._recv_buffer = bytearray(self.recv_buffer_size)
+        self._recv_view = memoryview(self._recv_buffer)
+        self._recv_start = 0
+        self._recv_end = 0
+        self._pcm_buffer = bytearray(self.recv_buffer_size)
+        self._pending_tokens = []
+        self._pending_code_block = False
+        self._pending_since = 0
+        self._tokens_started = False
+        # link estimates, measured by the client and reported in every ping
+        self.link_rtt_ms = 0.0
+        self.link_kbps = 0.0
+        self._last_probe_time = 0
+        self._probe_start = None
+        self.audio_profile = None
+        self.pending_audio_config = None
+        # session resumption: after authentication both ends count the frames
+        # they received and keep the last frames they sent, so a reconnecting
+        # peer can be replayed exactly what it missed
+        self.session_token = None
+        self.sessions = None
+        self.sessions_lock = None
+        self.frames_sent = 0
+        self.frames_received = 0
+        self._outbox = None
+        self._outbox_bytes = 0
+        self._attached = True
+        self._send_lock = threading.RLock()
+        self._recv_lock = threading.Lock()
+        self._resume_cond = threading.Condition()
+        self._generation = 0
+        self._recv_generation = 0
+        self._resume_address = None
+        # unix transport: large payloads go through shared memory, one ring per direction
+        self._shm_out = None
+        self._shm_in = None
+        # udp side channel for tts audio, so a lost packet doesn't stall the
+        # tcp stream; the server side sends, the client side reorders and
+        # conceals gaps through the decoder's packet loss path
+        self.udp_socket = None
+        self.udp_sessions = None
+        self.udp_session_id = None
+        self.udp_peer = None
+        self.udp_seq = 0
+        self._held_datagram = None
+        self.udp_con = None
+        self.udp_decoder = None
+        self.udp_ready = False
+        self._udp_cond = threading.Condition()
+        self._udp_pending = {}
+        self._udp_next_seq = 0
+        self._udp_frame_size = None
+        self._datagram_sink = None
+        self.udp_received = 0
+        self.udp_late = 0
+        self.udp_concealed = 0
 
     def server_init(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self.server_socket.bind((self.host_ip, self.port))
-        self.server_socket.listen(0)
+        if self.transport == "unix":
+            if os.path.exists(self.unix_socket_path):
+                os.unlink(self.unix_socket_path)
+            self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server_socket.bind(self.unix_socket_path)
+        else:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # restarting right after a run must not wait out TIME_WAIT
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.bind((self.host_ip, self.port))
+        self.server_socket.listen(self.max_clients or 0)
         
     def close_connection(self):
         self.con.close()
+        if self.udp_con is not None:
+            self.udp_con.close()
+            self.udp_con = None
+        for ring in (self._shm_out, self._shm_in):
+            if ring is not None:
+                ring.close()
+        self._shm_out = self._shm_in = None
+
+    def _open_shm_ring(self):
+        # announce our outgoing ring, the peer attaches it when the frame arrives
+        if self.transport == "unix" and self.shm_ring_bytes:
+            self._shm_out = ShmRing(size=self.shm_ring_bytes)
+            self.send_text(OP_SHM_RING, self._shm_out.name)
+
+    def authenticate(self):
+        self.send_frame(OP_HELLO, struct.pack("!H", PROTOCOL_VERSION))
+        opcode, flags, payload = self.receive_frame()
+        if opcode == OP_RESUME:
+            self._resume_session(payload)
+            return None
+        if opcode != OP_AUTH:
+            return None
+        username, _, password = str(payload, "utf-8").partition("\0")
+        if username in self.usernames_whitelist:
+            if password == self.passwords_whitelist[self.usernames_whitelist.index(username)]:
+                token = b""
+                if self.resume_grace_sec and self.sessions is not None:
+                    token = secrets.token_bytes(SESSION_TOKEN_SIZE)
+                    with self.sessions_lock:
+                        self.sessions[token] = self
+                self.send_frame(OP_AUTH_RESULT, token, FLAG_OK)
+                if token:
+                    self._start_session(token)
+                self._open_shm_ring()
+                self._offer_datagrams()
+                return username
+        self.send_frame(OP_AUTH_RESULT)
+        return None
+
+    def _start_session(self, token):
+        self.session_token = token
+        self.frames_sent = 0
+        self.frames_received = 0
+        self._outbox = deque()
+        self._outbox_bytes = 0
+
+    def end_session(self):
+        if self.session_token is not None and self.sessions is not None:
+            with self.sessions_lock:
+                self.sessions.pop(self.session_token, None)
+        if self.udp_session_id is not None and self.udp_sessions is not None:
+            with self.sessions_lock:
+                self.udp_sessions.pop(self.udp_session_id, None)
+        self.session_token = None
+        self._outbox = None
+
+    def send_bye(self):
+        # client side: the session ends here, losing the connection from now on
+        # is not resumed and the server frees the session at once
+        with self._send_lock:
+            self._resume_address = None
+            self.end_session()
+        try:
+            self.send_frame(OP_BYE)
+        except OSError:
+            pass
+
+    def _resume_session(self, payload):
+        # runs on the new connection's thread; on success the socket is handed
+        # over to the session and this Nw no longer owns it
+        token, peer_received = RESUME.unpack(payload)
+        session = None
+        if self.sessions is not None:
+            with self.sessions_lock:
+                session = self.sessions.get(token)
+        if session is None or not session._attach(self.con, peer_received):
+            self.send_frame(OP_RESUME_RESULT)
+            return
+        self.con = None
+
+    def _replay_range(self, peer_received):
+        # outbox frames the peer has not received, None if some already fell out
+        first = self.frames_sent - len(self._outbox)
+        if not first <= peer_received <= self.frames_sent:
+            return None
+        return list(self._outbox)[peer_received - first :]
+
+    def _attach(self, con, peer_received):
+        with self._send_lock:
+            if self._outbox is None or self._replay_range(peer_received) is None:
+                return False
+        # wake the session thread if it is still blocked on the old connection
+        self._detach()
+        with self._recv_lock, self._send_lock:
+            frames = None if self._outbox is None else self._replay_range(peer_received)
+            if frames is None:
+                return False
+            old_con = self.con
+            self.con = con
+            self.con.settimeout(self.idle_timeout_sec)
+            self._attached = True
+            # the session thread resets its receive buffer before the next frame
+            self._generation += 1
+            self.con.sendall(
+                FRAME_HEADER.pack(OP_RESUME_RESULT, FLAG_OK, 8)
+                + struct.pack("!Q", self.frames_received)
+            )
+            for frame in frames:
+                self.con.sendall(frame)
+            old_con.close()
+        with self._resume_cond:
+            self._resume_cond.notify_all()
+        return True
+
+    def _detach(self):
+        # frames sent from now on only go to the outbox until the peer resumes
+        with self._send_lock:
+            if self._attached:
+                self._attached = False
+                try:
+                    self.con.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def _wait_for_resume(self):
+        if self._resume_address is not None:
+            self._detach()
+            if not self._reconnect():
+                raise ConnectionError("session could not be resumed")
+            return
+        with self._send_lock:
+            # the client may already have resumed, don't cut off the new connection
+            if self._generation == self._recv_generation:
+                self._detach()
+                print("Client lost, waiting for it to resume...")
+        with self._resume_cond:
+            if not self._resume_cond.wait_for(
+                lambda: self._generation != self._recv_generation,
+                timeout=self.resume_grace_sec,
+            ):
+                raise ConnectionError("session expired")
+        print("Client resumed")
+
+    def _reconnect(self):
+        print("Connection lost, resuming session...")
+        deadline = time.time() + self.resume_grace_sec
+        while time.time() < deadline:
+            con = self._new_socket()
+            try:
+                con.settimeout(self.client_connect_timeout)
+                con.connect(self._resume_address)
+            except OSError:
+                con.close()
+                time.sleep(1)
+                continue
+            with self._send_lock:
+                try:
+                    if self._resume_handshake(con):
+                        print("Session resumed!")
+                        return True
+                    con.close()
+                    return False
+                except (OSError, ConnectionError, struct.error):
+                    con.close()
+            time.sleep(1)
+        return False
+
+    def _resume_handshake(self, con):
+        self.con.close()
+        self.con = con
+        self._recv_start = self._recv_end = 0
+        opcode, flags, length = FRAME_HEADER.unpack_from(self._read(FRAME_HEADER.size))
+        payload = self._read(length)
+        if opcode != OP_HELLO or struct.unpack("!H", payload)[0] != PROTOCOL_VERSION:
+            return False
+        payload = RESUME.pack(self.session_token, self.frames_received)
+        con.sendall(FRAME_HEADER.pack(OP_RESUME, 0, len(payload)) + payload)
+        opcode, flags, length = FRAME_HEADER.unpack_from(self._read(FRAME_HEADER.size))
+        payload = self._read(length)
+        if opcode != OP_RESUME_RESULT or not flags & FLAG_OK:
+            return False
+        frames = self._replay_range(struct.unpack("!Q", payload)[0])
+        if frames is None:
+            return False
+        con.settimeout(None)
+        for frame in frames:
+            con.sendall(frame)
+        self._attached = True
+        # the client may be on a new network, register the udp channel again
+        self.udp_ready = False
+        self._register_datagrams()
+        return True
 
     def server_listening(self):
         print("Server listening...")
         while True:
             self.con, client_address = self.server_socket.accept()
-            self.send_ack()
             try: # TODO remove try, when 1 client in que quits and current quit then error.
-                username = self.receive_msg()
-                password = self.receive_msg()
-                if username in self.usernames_whitelist:
-                    if password == self.passwords_whitelist[self.usernames_whitelist.index(username)]:
-                        self.send_msg("authentication successful")
-                        break
-                self.send_msg("authentication failed")
+                username = self.authenticate()
+                if username is not None:
+                    break
             except:
                 pass
             self.close_connection()
         print("Client connected:", client_address)
         return client_address, username
 
+    def session(self, con):
+        # every connection gets its own socket, codec state and buffers
+        nw = Nw(params=self.params)
+        nw.con = con
+        nw.sessions = self.sessions
+        nw.sessions_lock = self.sessions_lock
+        nw.udp_socket = self.udp_socket
+        nw.udp_sessions = self.udp_sessions
+        if self.encoder is not None:
+            nw.init_audio_encoder(*self.encoder_params)
+        if self.decoder is not None:
+            nw.init_audio_decoder(*self.decoder_params)
+        return nw
+
+    def serve_forever(self, handler):
+        print("Server listening...")
+        slots = threading.BoundedSemaphore(self.max_clients)
+        # sessions by token, so a dropped client can resume on a new connection
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        if self.udp_audio and self.audio_compression:
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_socket.bind((self.host_ip, self.udp_port))
+            self.udp_sessions = {}
+            threading.Thread(target=self._serve_datagrams, daemon=True).start()
+        while True:
+            con, client_address = self.server_socket.accept()
+            if not slots.acquire(blocking=False):
+                print("Client refused, server full:", client_address)
+                con.close()
+                continue
+            threading.Thread(
+                target=self._serve_connection,
+                args=(con, client_address, handler, slots),
+                daemon=True,
+            ).start()
+
+    def _serve_connection(self, con, client_address, handler, slots):
+        nw = self.session(con)
+        try:
+            con.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            con.settimeout(self.auth_timeout_sec)
+            username = nw.authenticate()
+            if username is None:
+                if nw.con is None:
+                    print("Client resumed session:", client_address)
+                else:
+                    print("Authentication failed:", client_address)
+                return
+            # a peer that sends nothing (not even heartbeats) for this long is dead
+            con.settimeout(self.idle_timeout_sec)
+            print("Client connected:", client_address, username)
+            handler(nw, username)
+        except (OSError, ConnectionError, struct.error, UnicodeDecodeError) as e:
+            print("Client error:", client_address, e)
+        finally:
+            nw.end_session()
+            if nw.con is not None:
+                nw.close_connection()
+            slots.release()
+
+    def _new_socket(self):
+        if self.transport == "unix":
+            return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        con = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        con.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return con
+
     def client_init(self):
-        self.con = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.con.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.con = self._new_socket()
 
     def client_connect(self, client_target_ip, client_target_port, username, password):
         self.client_init()
         self.con.settimeout(self.client_connect_timeout)
+        if self.transport == "unix":
+            address = self.unix_socket_path
+        else:
+            address = (client_target_ip, client_target_port)
         try:
-            self.con.connect((client_target_ip, client_target_port))
+            self.con.connect(address)
             self.con.settimeout(None)
-            self.receive_ack()
-            self.send_msg(username)
-            self.send_msg(password)
-            result = self.receive_msg()
-            if result == "authentication failed":
+            opcode, flags, payload = self.receive_frame()
+            if opcode != OP_HELLO or struct.unpack("!H", payload)[0] != PROTOCOL_VERSION:
+                self.close_connection()
+                print("Protocol version mismatch!")
+                return "protocol_mismatch"
+            self.send_frame(OP_AUTH, f"{username}\0{password}".encode())
+            opcode, flags, payload = self.receive_frame()
+            if not flags & FLAG_OK:
                 self.close_connection()
                 print("Authentication failed!")
                 return "authentication_failed"
             else:
+                if len(payload) == SESSION_TOKEN_SIZE and self.resume_grace_sec:
+                    self._resume_address = address
+                    self._start_session(bytes(payload))
+                self._open_shm_ring()
                 return "success"
         except socket.timeout:
             self.close_connection()
@@ -75,43 +494,230 @@ class Nw:
             return "socket_error"
 
     def init_audio_encoder(self, samplerate, channels, frame_size):
+        self.encoder_params = (samplerate, channels, frame_size)
         self.encoder_frame_size = frame_size
         self.encoder = opuslib.Encoder(samplerate, channels, opuslib.APPLICATION_VOIP)
-        # self.encoder._set_bitrate(96000)
+        # bitrate, complexity and frame size are adapted to the link, see set_audio_config
 
     def init_audio_decoder(self, samplerate, channels, frame_size):
-        self.decoder_frame_size = frame_size
+        self.decoder_params = (samplerate, channels, frame_size)
+        # the peer may switch to any opus frame duration, up to 120 ms
+        self.decoder_frame_size = max(frame_size, samplerate * 120 // 1000)
         self.decoder = opuslib.Decoder(samplerate, channels)
 
-    def send_ack(self):
-        self.con.sendall("A".encode())
-
-    # def send_msg(self, msg, fixed_length=0):
-    #     if fixed_length > 0:
-    #         msg = msg + "@" * (fixed_length - len(msg))
-    #     self.con.sendall(msg.encode())
-    def send_msg(self, msg):
-        if isinstance(msg, int):
-            # msg = struct.pack('!I', 0) + struct.pack('!I', msg)
-            msg = struct.pack("!II", 0, msg)
-        elif isinstance(msg, float):
-            # msg = struct.pack('!I', 1) + struct.pack('!f', msg)
-            msg = struct.pack("!If", 1, msg)
-        elif isinstance(msg, str):
-            msg_bytes = msg.encode()
-            # msg = struct.pack('!I', 2) + struct.pack('!I', len(msg_bytes)) + msg_bytes
-            msg = struct.pack("!II", 2, len(msg_bytes)) + msg_bytes
-        self.con.sendall(msg)
+    def set_audio_config(self, bitrate, complexity, frame_ms):
+        self.encoder.bitrate = bitrate
+        self.encoder.complexity = complexity
+        self.encoder_frame_size = self.encoder_params[0] * frame_ms // 1000
 
-    def send_audio_chunk(self, data):
-        if self.audio_compression:
-            data = self.encoder.encode(data, self.encoder_frame_size)
-            encoded_data_size = len(data)
-            self.send_msg(encoded_data_size)
-        self.con.sendall(data)
+    def _select_audio_profile(self):
+        for profile in self.audio_profiles:
+            max_rtt_ms = profile.get("max_rtt_ms", None)
+            if (max_rtt_ms is None or self.link_rtt_ms <= max_rtt_ms) and (
+                self.link_kbps >= profile.get("min_kbps", 0)
+            ):
+                return profile
+        return self.audio_profiles[-1]
 
-    def send_audio_recording(self, data):
+    def send_frame(self, opcode, payload=b"", flags=0):
+        with self._send_lock:
+            if self._shm_out is not None and len(payload) >= self.shm_min_bytes:
+                ref = self._shm_out.write(payload)
+                # a full ring just means this payload goes inline
+                if ref is not None:
+                    payload, flags = ref, flags | FLAG_SHM
+            header = FRAME_HEADER.pack(opcode, flags, len(payload))
+            if self._outbox is None:
+                self._sendall(header, payload)
+            else:
+                # kept for replay until it falls out of the bounded outbox; a
+                # peer that missed frames evicted since can't resume
+                self._outbox.append(header + payload)
+                self._outbox_bytes += len(header) + len(payload)
+                while self._outbox and (
+                    len(self._outbox) > self.resume_buffer_frames
+                    or self._outbox_bytes > self.resume_buffer_bytes
+                ):
+                    self._outbox_bytes -= len(self._outbox.popleft())
+                self.frames_sent += 1
+                if self._attached:
+                    try:
+                        self._sendall(header, payload)
+                    except OSError:
+                        self._detach()
+            self.last_send_time = time.time()
+
+    def _sendall(self, header, payload):
+        if len(payload) <= 16384:
+            self.con.sendall(header + payload)
+        else:
+            self.con.sendall(header)
+            self.con.sendall(payload)
+
+    def send_text(self, opcode, text, flags=0):
+        self.send_frame(opcode, text.encode(), flags)
+
+    def _offer_datagrams(self):
+        if self.udp_socket is not None:
+            self.udp_session_id = secrets.randbits(64)
+            with self.sessions_lock:
+                self.udp_sessions[self.udp_session_id] = self
+            self.send_frame(OP_UDP_OFFER, UDP_OFFER.pack(self.udp_session_id, self.udp_port))
+
+    def _serve_datagrams(self):
+        # clients register their address by sending their session id
+        while True:
+            data, address = self.udp_socket.recvfrom(64)
+            if len(data) != DATAGRAM.size:
+                continue
+            with self.sessions_lock:
+                nw = self.udp_sessions.get(DATAGRAM.unpack(data)[0])
+            if nw is not None:
+                nw.udp_peer = address
+                try:
+                    nw.send_frame(OP_UDP_READY)
+                except OSError:
+                    pass
+
+    def start_datagrams(self, payload, sink):
+        # client side, sink gets the decoded pcm of every datagram in order
+        if not (self.udp_audio and self.audio_compression) or self.udp_con is not None:
+            return
+        self.udp_session_id, port = UDP_OFFER.unpack(payload)
+        self._datagram_sink = sink
+        self._udp_frame_size = self.decoder_params[0] * 20 // 1000
+        # decoded on the udp thread, the tcp receiver keeps its own decoder state
+        self.udp_decoder = opuslib.Decoder(*self.decoder_params[:2])
+        self.udp_con = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # a sentence of tts is encoded and sent in one burst
+        self.udp_con.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.udp_con.connect((self.con.getpeername()[0], port))
+        threading.Thread(target=self._receive_datagrams, daemon=True).start()
+        self._register_datagrams()
+
+    def _register_datagrams(self):
+        if self.udp_con is not None and not self.udp_ready:
+            try:
+                self.udp_con.send(DATAGRAM.pack(self.udp_session_id, 0))
+            except OSError:
+                pass
+
+    def send_heartbeat(self):
+        # pings keep the connection alive when quiet and carry the link
+        # measurements the server adapts the audio codec to;
+        # registration datagrams may be lost, repeat until the server confirms
+        self._register_datagrams()
+        now = time.time()
+        probe = (
+            self.link_probe_interval_sec is not None
+            and now - self._last_probe_time >= self.link_probe_interval_sec
+        )
+        if probe or (
+            self.heartbeat_interval_sec
+            and now - self.last_send_time >= self.heartbeat_interval_sec
+        ):
+            if probe:
+                self._last_probe_time = now
+            self.send_frame(
+                OP_PING,
+                PING.pack(time.monotonic(), self.link_rtt_ms, self.link_kbps),
+                FLAG_PROBE if probe else 0,
+            )
+
+    def handle_ping(self, payload, flags):
+        sent, rtt_ms, kbps = PING.unpack(payload)
+        self.send_frame(OP_PONG, payload[:8])
+        if flags & FLAG_PROBE:
+            self.send_frame(OP_PROBE, bytes(self.link_probe_bytes))
+        if not self.audio_compression or not self.audio_profiles or kbps <= 0:
+            return
+        self.link_rtt_ms, self.link_kbps = rtt_ms, kbps
+        profile = self._select_audio_profile()
+        if profile is not self.audio_profile:
+            self.audio_profile = profile
+            config = (profile["bitrate"], profile["complexity"], profile["frame_ms"])
+            self.set_audio_config(*config)
+            self.send_frame(
+                OP_AUDIO_CONFIG, AUDIO_CONFIG.pack(*config) + profile["name"].encode()
+            )
+            self._print_audio_config(profile["name"], *config)
+
+    def _print_audio_config(self, name, bitrate, complexity, frame_ms):
+        print(
+            f"Audio profile {name}: rtt {self.link_rtt_ms:.0f} ms,"
+            f" {self.link_kbps:.0f} kbps -> {bitrate // 1000} kbps,"
+            f" complexity {complexity}, {frame_ms} ms frames"
+        )
+
+    def handle_pong(self, payload):
+        now = time.monotonic()
+        rtt_ms = (now - struct.unpack_from("!d", payload)[0]) * 1000
+        # smoothed so one slow reply doesn't flip the profile
+        if self.link_rtt_ms == 0:
+            self.link_rtt_ms = rtt_ms
+        else:
+            self.link_rtt_ms = 0.8 * self.link_rtt_ms + 0.2 * rtt_ms
+        self._probe_start = now
+
+    def handle_probe(self, payload):
+        # the probe was queued right behind the pong, its arrival spread is
+        # roughly its serialisation time on the bottleneck link
+        elapsed = max(time.monotonic() - self._probe_start, 1e-4)
+        kbps = len(payload) * 8 / 1000 / elapsed
+        if self.link_kbps == 0:
+            self.link_kbps = kbps
+        else:
+            self.link_kbps = 0.7 * self.link_kbps + 0.3 * kbps
+
+    def handle_audio_config(self, payload):
+        # applied by the sending thread before it encodes the next packet
+        bitrate, complexity, frame_ms = AUDIO_CONFIG.unpack_from(payload)
+        name = str(payload[AUDIO_CONFIG.size :], "utf-8")
+        self.pending_audio_config = (bitrate, complexity, frame_ms)
+        self._print_audio_config(name, bitrate, complexity, frame_ms)
+
+    def send_token(self, text, code_block):
+        # tokens are coalesced for token_coalesce_ms, the first one goes out at once
+        now = time.time()
+        if self._pending_tokens and code_block != self._pending_code_block:
+            self.flush_tokens()
+        if not self._pending_tokens:
+            self._pending_since = now
+        self._pending_tokens.append(text)
+        self._pending_code_block = code_block
+        if (
+            not self._tokens_started
+            or (now - self._pending_since) * 1000 >= self.token_coalesce_ms
+        ):
+            self.flush_tokens()
+
+    def coalesce_remaining(self):
+        # seconds until the pending tokens are due, None when none are pending
+        if not self._pending_tokens:
+            return None
+        return max(self._pending_since + self.token_coalesce_ms / 1000 - time.time(), 0)
+
+    def flush_tokens(self):
+        if not self._pending_tokens:
+            return
+        text = "".join(self._pending_tokens).encode()
+        flags = FLAG_CODE_BLOCK if self._pending_code_block else 0
+        self.send_frame(OP_LLM_TOKEN, TOKEN_LENGTH.pack(len(text)) + text, flags)
+        self._pending_tokens = []
+        self._tokens_started = True
+
+    def send_streaming_end(self):
+        if self._pending_tokens:
+            self.flush_tokens()
+        self._tokens_started = False
+        self.send_frame(OP_STREAMING_END)
+
+    def _encode_audio(self, data):
+        # yields one opus packet per encoder frame, carrying leftovers to the next call
         if self.audio_compression:
+            if self.pending_audio_config is not None:
+                self.set_audio_config(*self.pending_audio_config)
+                self.pending_audio_config = None
             if len(self.data_remaining) > 0:
                 self.buffer.extend(self.data_remaining)
             self.buffer.extend(data)
@@ -124,67 +730,274 @@ class Nw:
                 data = bytes(self.buffer)
             self.buffer = bytearray()
             for index in range(0, len(data), self.encoder_frame_size * 2):
-                encoded_chunk = self.encoder.encode(
+                yield self.encoder.encode(
                     data[index : index + self.encoder_frame_size * 2],
                     self.encoder_frame_size,
                 )
-                encoded_chunk_size = len(encoded_chunk)
-                self.send_msg(encoded_chunk_size)
-                self.con.sendall(encoded_chunk)
-            self.send_msg("audio_transmit_done")
         else:
-            self.send_msg(len(data))
-            self.con.sendall(data)
-
-    def receive_ack(self):
-        ack = self.con.recv(1, socket.MSG_WAITALL)
-
-    # def receive_msg(self, n_bytes=1024, waitall=False):
-    #     msg = self.con.recv(n_bytes, socket.MSG_WAITALL).decode()
-    #     if not waitall:
-    #         msg = re.sub(r'(\w+)@+', r'\1', msg)
-    #     return msg
-    def receive_msg(self):
-        type_indicator = self.con.recv(4, socket.MSG_WAITALL)
-        type_indicator = struct.unpack("!I", type_indicator)[0]
-
-        if type_indicator == 0:
-            msg_bytes = self.con.recv(4, socket.MSG_WAITALL)
-            msg = struct.unpack("!I", msg_bytes)[0]
-        elif type_indicator == 1:
-            msg_bytes = self.con.recv(4, socket.MSG_WAITALL)
-            msg = struct.unpack("!f", msg_bytes)[0]
-        elif type_indicator == 2:
-            msg_length_bytes = self.con.recv(4, socket.MSG_WAITALL)
-            msg_length = struct.unpack("!I", msg_length_bytes)[0]
-            msg_bytes = self.con.recv(msg_length, socket.MSG_WAITALL)
-            msg = msg_bytes.decode()
-
-        return msg
-
-    def receive_audio_chunk(self, n_bytes):
+            yield data
+
+    def send_audio_chunk(self, data):
+        for packet in self._encode_audio(data):
+            self.send_frame(OP_MIC_STREAM, packet)
+
+    def send_audio_recording(self, data):
+        for packet in self._encode_audio(data):
+            self.send_frame(OP_AUDIO, packet)
+        self.send_frame(OP_AUDIO_END)
+
+    def send_tts_audio(self, data):
+        for packet in self._encode_audio(data):
+            if self.udp_peer is not None and self.audio_compression:
+                self._send_datagram(packet)
+            else:
+                self.send_frame(OP_TTS_AUDIO, packet)
+
+    def _send_datagram(self, packet):
+        datagram = DATAGRAM.pack(self.udp_session_id, self.udp_seq) + packet
+        self.udp_seq += 1
+        # injected loss and reordering, to test concealment on loopback
+        if random.random() < self.udp_loss_rate:
+            return
+        if self._held_datagram is None and random.random() < self.udp_reorder_rate:
+            self._held_datagram = datagram
+            return
+        try:
+            self.udp_socket.sendto(datagram, self.udp_peer)
+            if self._held_datagram is not None:
+                self.udp_socket.sendto(self._held_datagram, self.udp_peer)
+        except OSError:
+            pass
+        self._held_datagram = None
+
+    def send_tts_end(self):
+        if self.udp_peer is None:
+            self.send_frame(OP_TTS_END)
+            return
+        if self._held_datagram is not None:
+            try:
+                self.udp_socket.sendto(self._held_datagram, self.udp_peer)
+            except OSError:
+                pass
+            self._held_datagram = None
+        self.send_frame(OP_TTS_END, struct.pack("!I", self.udp_seq))
+
+    def _receive_datagrams(self):
+        udp_con = self.udp_con
+        while True:
+            try:
+                data = udp_con.recv(65536)
+            except ConnectionRefusedError:
+                # icmp from an earlier registration, the server wasn't ready yet
+                continue
+            except OSError:
+                return
+            if len(data) <= DATAGRAM.size:
+                continue
+            session_id, seq = DATAGRAM.unpack_from(data)
+            if session_id != self.udp_session_id:
+                continue
+            with self._udp_cond:
+                self.udp_received += 1
+                if seq < self._udp_next_seq:
+                    # already concealed
+                    self.udp_late += 1
+                    continue
+                self._udp_pending[seq] = data[DATAGRAM.size :]
+                self._release_datagrams()
+                self._udp_cond.notify_all()
+
+    def _release_datagrams(self, end_seq=None):
+        # play out in order; a gap is concealed once a packet udp_reorder_window
+        # further on has arrived, or when the stream ended without it
+        while True:
+            packet = self._udp_pending.pop(self._udp_next_seq, None)
+            if packet is not None:
+                pcm = self.udp_decoder.decode(packet, self.decoder_frame_size)
+                self._udp_frame_size = len(pcm) // (2 * self.decoder_params[1])
+            else:
+                ended = end_seq is not None and self._udp_next_seq < end_seq
+                overdue = (
+                    self._udp_pending
+                    and max(self._udp_pending) - self._udp_next_seq
+                    >= self.udp_reorder_window
+                )
+                if not (ended or overdue):
+                    return
+                pcm = opuslib.api.decoder.decode(
+                    self.udp_decoder.decoder_state,
+                    None,
+                    0,
+                    self._udp_frame_size,
+                    False,
+                    self.decoder_params[1],
+                )
+                self.udp_concealed += 1
+            self._udp_next_seq += 1
+            self._datagram_sink(pcm)
+
+    def finish_datagrams(self, payload):
+        # on OP_TTS_END: wait briefly for stragglers, conceal whatever is still missing
+        if self.udp_con is None or len(payload) < 4:
+            return
+        end_seq = struct.unpack_from("!I", payload)[0]
+        with self._udp_cond:
+            self._udp_cond.wait_for(
+                lambda: self._udp_next_seq >= end_seq,
+                timeout=self.udp_end_wait_ms / 1000,
+            )
+            self._release_datagrams(end_seq)
+
+    def datagram_stats(self):
+        return {
+            "received": self.udp_received,
+            "late": self.udp_late,
+            "concealed": self.udp_concealed,
+        }
+
+    def _fill(self, n_bytes):
+        # make sure n_bytes are buffered, reading as much as the socket has
+        if self._recv_start + n_bytes > len(self._recv_buffer):
+            pending = self._recv_end - self._recv_start
+            if n_bytes > len(self._recv_buffer):
+                # never resize in place, earlier views may still be exported
+                new_buffer = bytearray(max(n_bytes, 2 * len(self._recv_buffer)))
+                new_buffer[:pending] = self._recv_view[self._recv_start : self._recv_end]
+                self._recv_buffer = new_buffer
+                self._recv_view = memoryview(new_buffer)
+            else:
+                self._recv_view[:pending] = self._recv_view[
+                    self._recv_start : self._recv_end
+                ]
+            self._recv_start = 0
+            self._recv_end = pending
+        while self._recv_end - self._recv_start < n_bytes:
+            # MSG_WAITALL is not honoured once a timeout makes the socket non-blocking
+            n = self.con.recv_into(self._recv_view[self._recv_end :])
+            if n == 0:
+                raise ConnectionError("connection closed by peer")
+            self._recv_end += n
+
+    def _read(self, n_bytes):
+        self._fill(n_bytes)
+        view = self._recv_view[self._recv_start : self._recv_start + n_bytes]
+        self._recv_start += n_bytes
+        if self._recv_start == self._recv_end:
+            self._recv_start = self._recv_end = 0
+        return view
+
+    def _recv_into(self, out, n_bytes):
+        # large payloads bypass the receive buffer and land directly in `out`
+        view = memoryview(out)
+        buffered = min(n_bytes, self._recv_end - self._recv_start)
+        view[:buffered] = self._read(buffered)
+        received = buffered
+        while received < n_bytes:
+            n = self.con.recv_into(view[received:n_bytes], n_bytes - received)
+            if n == 0:
+                raise ConnectionError("connection closed by peer")
+            received += n
+        return view[:n_bytes]
+
+    def _decode_into(self, packet, offset):
+        # decode one opus packet straight into the pcm buffer at offset
+        channels = self.decoder_params[1]
+        max_bytes = self.decoder_frame_size * channels * 2
+        self._pcm_buffer_for(offset + max_bytes, keep=offset)
+        pcm = (ctypes.c_int16 * (max_bytes // 2)).from_buffer(self._pcm_buffer, offset)
+        opus_data = (ctypes.c_char * len(packet)).from_buffer(packet)
+        result = opuslib.api.decoder.libopus_decode(
+            self.decoder.decoder_state,
+            ctypes.cast(opus_data, ctypes.c_char_p),
+            len(packet),
+            pcm,
+            self.decoder_frame_size,
+            0,
+        )
+        del pcm, opus_data
+        if result < 0:
+            raise opuslib.OpusError(result)
+        return result * channels * 2
+
+    def _receive(self, read_payload):
+        # one frame; if the connection drops midway the session is resumed and
+        # the frame is read again from the peer's replay
+        while True:
+            with self._recv_lock:
+                if self._recv_generation != self._generation:
+                    self._recv_generation = self._generation
+                    self._recv_start = self._recv_end = 0
+                if self._shm_in is not None:
+                    # the previous payload view is no longer in use
+                    self._shm_in.release()
+                try:
+                    opcode, flags, length = FRAME_HEADER.unpack_from(
+                        self._read(FRAME_HEADER.size)
+                    )
+                    ring_payload = None
+                    if opcode == OP_SHM_RING:
+                        self._shm_in = ShmRing(name=str(self._read(length), "utf-8"))
+                        self.frames_received += 1
+                        continue
+                    if flags & FLAG_SHM:
+                        ring_payload = self._shm_in.read(self._read(length))
+                        flags &= ~FLAG_SHM
+                    payload = read_payload(opcode, length, ring_payload)
+                    self.frames_received += 1
+                    return opcode, flags, payload
+                except (OSError, ConnectionError):
+                    if self._outbox is None:
+                        raise
+            self._wait_for_resume()
+
+    def receive_frame(self):
+        return self._receive(
+            lambda opcode, length, ring_payload: (
+                self._read(length) if ring_payload is None else ring_payload
+            )
+        )
+
+    def unpack_token(self, payload, flags):
+        text_length = TOKEN_LENGTH.unpack_from(payload)[0]
+        end = TOKEN_LENGTH.size + text_length
+        text = str(payload[TOKEN_LENGTH.size : end], "utf-8")
+        return text, flags & FLAG_CODE_BLOCK != 0
+
+    def decode_audio(self, packet):
         if self.audio_compression:
-            encoded_data_size = self.receive_msg()
-            encoded_data = self.con.recv(encoded_data_size, socket.MSG_WAITALL)
-            data = self.decoder.decode(encoded_data, self.decoder_frame_size)
-        else:
-            data = self.con.recv(n_bytes, socket.MSG_WAITALL)
-        return data
+            return memoryview(self._pcm_buffer)[: self._decode_into(packet, 0)]
+        return packet
 
     def receive_audio_recording(self):
-        if self.audio_compression:
-            data = bytearray()
-            while True:
-                encoded_data_size = self.receive_msg()
-                if encoded_data_size == "audio_transmit_done":
-                    break
-                # print("bitrate:", (encoded_data_size * 8) / (960 / 24000))
-                encoded_recording = self.con.recv(encoded_data_size, socket.MSG_WAITALL)
-                decoded_data = self.decoder.decode(
-                    encoded_recording, self.decoder_frame_size
-                )
-                data.extend(decoded_data)
-        else:
-            encoded_data_size = self.receive_msg()
-            data = self.con.recv(encoded_data_size, socket.MSG_WAITALL)
-        return data
+        n_received = 0
+
+        def read_payload(opcode, length, ring_payload):
+            if opcode == OP_AUDIO_END:
+                return 0
+            if ring_payload is None and self.audio_compression:
+                return self._decode_into(self._read(length), n_received)
+            if ring_payload is not None:
+                length = len(ring_payload)
+            out = memoryview(self._pcm_buffer_for(n_received + length, keep=n_received))[
+                n_received : n_received + length
+            ]
+            if ring_payload is not None:
+                out[:] = ring_payload
+            else:
+                self._recv_into(out, length)
+            return length
+
+        while True:
+            opcode, flags, n_decoded = self._receive(read_payload)
+            if opcode == OP_AUDIO_END:
+                break
+            n_received += n_decoded
+        return memoryview(self._pcm_buffer)[:n_received]
+
+    def _pcm_buffer_for(self, n_bytes, keep=0):
+        # grow by replacing, earlier views may still be exported
+        if n_bytes > len(self._pcm_buffer):
+            new_buffer = bytearray(max(n_bytes, 2 * len(self._pcm_buffer)))
+            new_buffer[:keep] = self._pcm_buffer[:keep]
+            self._pcm_buffer = new_buffer
+        return self._pcm_buffer
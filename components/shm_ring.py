@@ -0,0 +1,61 @@
+import struct
+from multiprocessing import shared_memory, resource_tracker
+
+
+RING_HEADER = struct.Struct("!Q")  # consumed position, written by the reading end
+DATA_OFFSET = 64
+REF = struct.Struct("!QI")  # position, length of one payload in the ring
+
+
+class ShmRing:
+    # single producer, single consumer ring of frame payloads in shared memory;
+    # positions only grow, a payload is never split across the end of the ring
+    def __init__(self, name=None, size=0):
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=DATA_OFFSET + size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # the creating end unlinks it, this process' tracker must not
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.name = self.shm.name
+        self.capacity = self.shm.size - DATA_OFFSET
+        self._write_pos = 0
+        self._release_pos = None
+
+    def write(self, data):
+        # returns a REF to the copied payload, None when the ring is too full
+        n_bytes = len(data)
+        pos = self._write_pos
+        offset = pos % self.capacity
+        if offset + n_bytes > self.capacity:
+            pos += self.capacity - offset
+            offset = 0
+        consumed = RING_HEADER.unpack_from(self.shm.buf, 0)[0]
+        if pos + n_bytes - consumed > self.capacity:
+            return None
+        start = DATA_OFFSET + offset
+        self.shm.buf[start : start + n_bytes] = data
+        self._write_pos = pos + n_bytes
+        return REF.pack(pos, n_bytes)
+
+    def read(self, ref):
+        # a view into the ring, valid until release()
+        pos, n_bytes = REF.unpack(ref)
+        start = DATA_OFFSET + pos % self.capacity
+        self._release_pos = pos + n_bytes
+        return self.shm.buf[start : start + n_bytes]
+
+    def release(self):
+        if self._release_pos is not None:
+            RING_HEADER.pack_into(self.shm.buf, 0, self._release_pos)
+            self._release_pos = None
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:
+            # a view handed out by read() is still alive, the mapping goes with the process
+            pass
+        if self.owner:
+            self.shm.unlink()
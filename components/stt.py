@@ -1,4 +1,6 @@
+import zlib
 import warnings
+import threading
 import torch
 import transformers
 from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
@@ -13,11 +15,36 @@ class Stt:
         self.attn = self.params.get("attn", None)
         self.verbose = self.params.get("verbose", None)
         self.language = self.params.get("language", None)
+        # "torch", "torch_int8" (dynamic quantization, cpu) or "onnx" (onnxruntime)
+        self.backend = self.params.get("backend", None) or "torch"
+        self.onnx_model_name = self.params.get("onnx_model_name", None)
+        # utterances shorter than one whisper window skip the chunked pipeline
+        self.fast_path = self.params.get("fast_path", None)
+        self.fast_path_tokens_per_sec = self.params.get("fast_path_tokens_per_sec", None) or 10
+        self.max_new_tokens = 128
+        # drop transcripts of noise before they reach the llm, same rules as whisper:
+        # silent when no_speech_prob is high and avg_logprob low, or too repetitive
+        self.confidence_gating = self.params.get("confidence_gating", None)
+        self.no_speech_threshold = self.params.get("no_speech_threshold", None) or 0.6
+        self.logprob_threshold = self.params.get("logprob_threshold", None) or -1.0
+        self.compression_ratio_threshold = (
+            self.params.get("compression_ratio_threshold", None) or 2.4
+        )
+        self.rejected_turns = 0
+        self.streaming = self.params.get("streaming", None)
+        self.stream_interval_sec = self.params.get("stream_interval_sec", None) or 1.0
+        self.stream_min_sec = self.params.get("stream_min_sec", None) or 1.0
 
         if not self.verbose:
             transformers.logging.set_verbosity_error()
             warnings.filterwarnings("ignore", module="transformers")
 
+        if self.backend not in ("torch", "torch_int8", "onnx"):
+            raise ValueError(f"Unknown Stt backend: {self.backend}")
+        if self.backend != "torch":
+            # both quantized backends run on cpu
+            self.device = "cpu"
+
         if self.device == "cpu":
             self.attn = "sdpa"
 
@@ -27,29 +54,161 @@ class Stt:
             else torch.float32
         )
 
-        model = AutoModelForSpeechSeq2Seq.from_pretrained(
-            self.model_name,
-            torch_dtype=torch_dtype,
-            low_cpu_mem_usage=self.low_cpu_mem_usage,
-            use_safetensors=True,
-            attn_implementation=self.attn,
-            device_map=self.device,
-        )
+        if self.backend == "onnx":
+            # optional dependency, only needed for this backend
+            from optimum.onnxruntime import ORTModelForSpeechSeq2Seq
+
+            # onnx_model_name points to an exported (and possibly int8 quantized)
+            # model, otherwise model_name is exported on first load
+            model = ORTModelForSpeechSeq2Seq.from_pretrained(
+                self.onnx_model_name or self.model_name,
+                export=self.onnx_model_name is None,
+                provider="CPUExecutionProvider",
+            )
+        else:
+            model = AutoModelForSpeechSeq2Seq.from_pretrained(
+                self.model_name,
+                torch_dtype=torch_dtype,
+                low_cpu_mem_usage=self.low_cpu_mem_usage,
+                use_safetensors=True,
+                attn_implementation=self.attn,
+                device_map=self.device,
+            )
+        if self.backend == "torch_int8":
+            # int8 weights for the linear layers, activations quantized on the fly
+            model = torch.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
 
         processor = AutoProcessor.from_pretrained(self.model_name)
+        self.samplerate = processor.feature_extractor.sampling_rate
+        self.window_samples = processor.feature_extractor.n_samples
+        self.model = model
+        self.processor = processor
+        self.torch_dtype = torch_dtype
         self.pipe = pipeline(
             "automatic-speech-recognition",
             model=model,
             tokenizer=processor.tokenizer,
             feature_extractor=processor.feature_extractor,
-            max_new_tokens=128,
+            max_new_tokens=self.max_new_tokens,
             chunk_length_s=30,
             batch_size=16,
             return_timestamps=True,
             torch_dtype=torch_dtype,
         )
+        self.lock = threading.Lock()
+
+    def transcribe_batch(self, batch, timestamps=True):
+        # one model call for several utterances, see SttBatcher
+        with self.lock:
+            if (
+                (self.fast_path or self.confidence_gating)
+                and not timestamps
+                and all(len(data) <= self.window_samples for data in batch)
+            ):
+                return self._generate(batch)
+            return self.pipe(batch, generate_kwargs={"language": self.language})
+
+    def _generate(self, batch):
+        # a single window each: no chunking, strides or timestamp tokens,
+        # and a token budget that follows the longest utterance
+        features = self.processor.feature_extractor(
+            batch, sampling_rate=self.samplerate, return_tensors="pt"
+        ).input_features.to(self.model.device, dtype=self.torch_dtype)
+        duration = max(len(data) for data in batch) / self.samplerate
+        max_new_tokens = min(
+            int(duration * self.fast_path_tokens_per_sec) + 16, self.max_new_tokens
+        )
+        generation_config = self.model.generation_config
+        with torch.inference_mode():
+            # the encoder runs once for both the no speech check and generate
+            encoder_outputs = self.model.get_encoder()(features)
+            start_tokens = torch.full(
+                (len(batch), 1),
+                generation_config.decoder_start_token_id,
+                device=self.model.device,
+            )
+            logits = self.model(
+                encoder_outputs=encoder_outputs, decoder_input_ids=start_tokens
+            ).logits[:, 0].float()
+            # <|nospeech|> sits right before <|notimestamps|>, as in transformers
+            no_speech_probs = logits.softmax(dim=-1)[
+                :, generation_config.no_timestamps_token_id - 1
+            ].tolist()
+            output = self.model.generate(
+                encoder_outputs=encoder_outputs,
+                language=self.language,
+                max_new_tokens=max_new_tokens,
+                return_dict_in_generate=True,
+                output_scores=True,
+            )
+            # one score per generated token, aligned with the end of the sequences
+            generated = output.sequences[:, -len(output.scores) :]
+            logprobs = (
+                torch.stack(output.scores, dim=1)
+                .float()
+                .log_softmax(dim=-1)
+                .gather(-1, generated.unsqueeze(-1))
+                .squeeze(-1)
+            )
+            mask = generated != generation_config.pad_token_id
+            avg_logprobs = (
+                (logprobs * mask).sum(dim=-1) / mask.sum(dim=-1).clamp(min=1)
+            ).tolist()
+        texts = self.processor.batch_decode(output.sequences, skip_special_tokens=True)
+        outputs = []
+        for text, no_speech_prob, avg_logprob in zip(texts, no_speech_probs, avg_logprobs):
+            text = text.strip()
+            outputs.append(
+                {
+                    # same leading space as the pipeline output
+                    "text": " " + text,
+                    "confidence": {
+                        "no_speech_prob": round(no_speech_prob, 3),
+                        "avg_logprob": round(avg_logprob, 3),
+                        "compression_ratio": round(compression_ratio(text), 3),
+                    },
+                }
+            )
+        return outputs
 
-    def transcribe_translate(self, data):
-        data = self.pipe(data, generate_kwargs={"language": self.language})
+    def transcribe_translate(self, data, return_confidence=False):
+        # confidence is None when the chunked pipeline was used
+        data = self.transcribe_batch([data], timestamps=False)[0]
+        if return_confidence:
+            return data["text"][1:], data.get("confidence", None)
         data = data["text"][1:]
         return data
+
+    def check_confidence(self, confidence):
+        # False when the transcript should be dropped, counted in rejected_turns
+        if not self.confidence_gating or confidence is None:
+            return True
+        silent = (
+            confidence["no_speech_prob"] > self.no_speech_threshold
+            and confidence["avg_logprob"] < self.logprob_threshold
+        )
+        repetitive = confidence["compression_ratio"] > self.compression_ratio_threshold
+        if silent or repetitive:
+            self.rejected_turns += 1
+            print("STT rejected:", confidence, "rejected turns:", self.rejected_turns)
+            return False
+        return True
+
+    def transcribe_segments(self, data):
+        # [(text, start sec, end sec)], end is None when the model cut off mid segment
+        data = self.transcribe_batch([data])[0]
+        return [
+            (chunk["text"], chunk["timestamp"][0], chunk["timestamp"][1])
+            for chunk in data.get("chunks", [])
+        ]
+
+
+def compression_ratio(text):
+    # high for repeated phrases, a common whisper hallucination
+    text_bytes = text.encode("utf-8")
+    if not text_bytes:
+        return 0.0
+    return len(text_bytes) / len(zlib.compress(text_bytes))
+
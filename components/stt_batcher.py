@@ -0,0 +1,97 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class SttBatcher:
+    # same interface as Stt; requests from concurrent sessions that arrive
+    # within batch_max_wait_ms are run through the model in one call
+    def __init__(self, stt, params=None):
+        self.params = params or {}
+        self.batch_max_size = self.params.get("batch_max_size", None) or 8
+        self.batch_max_wait_ms = self.params.get("batch_max_wait_ms", None) or 0
+        self.batch_log_every = self.params.get("batch_log_every", None)
+        self.stt = stt
+        self.samplerate = stt.samplerate
+        self.window_samples = stt.window_samples
+        self.streaming = stt.streaming
+        self.stream_interval_sec = stt.stream_interval_sec
+        self.stream_min_sec = stt.stream_min_sec
+        self._queue = queue.Queue()
+        self.batches = 0
+        self.requests = 0
+        self.batch_sizes = {}
+        self.queue_wait_sec = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _submit(self, data, timestamps):
+        future = Future()
+        self._queue.put((data, timestamps, future, time.monotonic()))
+        return future.result()
+
+    def transcribe_translate(self, data, return_confidence=False):
+        output = self._submit(data, False)
+        if return_confidence:
+            return output["text"][1:], output.get("confidence", None)
+        return output["text"][1:]
+
+    def check_confidence(self, confidence):
+        return self.stt.check_confidence(confidence)
+
+    def transcribe_segments(self, data):
+        return [
+            (chunk["text"], chunk["timestamp"][0], chunk["timestamp"][1])
+            for chunk in self._submit(data, True).get("chunks", [])
+        ]
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_max_wait_ms / 1000
+            while len(batch) < self.batch_max_size:
+                try:
+                    # whatever is already queued joins, then wait out the window
+                    batch.append(
+                        self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                    )
+                except queue.Empty:
+                    break
+            start = time.monotonic()
+            # final transcripts and streaming segments take different model paths
+            for timestamps in (False, True):
+                requests = [request for request in batch if request[1] == timestamps]
+                if requests:
+                    self._transcribe(requests, timestamps)
+            self._record(batch, start)
+
+    def _transcribe(self, requests, timestamps):
+        try:
+            outputs = self.stt.transcribe_batch(
+                [data for data, _, _, _ in requests], timestamps=timestamps
+            )
+        except Exception as e:
+            for _, _, future, _ in requests:
+                future.set_exception(e)
+            return
+        for (_, _, future, _), output in zip(requests, outputs):
+            future.set_result(output)
+
+    def _record(self, batch, start):
+        self.batches += 1
+        self.requests += len(batch)
+        self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+        self.queue_wait_sec += sum(start - queued for _, _, _, queued in batch)
+        if self.batch_log_every and self.batches % self.batch_log_every == 0:
+            print("STT batching:", self.stats())
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_fill": round(
+                self.requests / max(self.batches, 1) / self.batch_max_size, 3
+            ),
+            "sizes": dict(sorted(self.batch_sizes.items())),
+            "mean_queue_ms": round(self.queue_wait_sec / max(self.requests, 1) * 1000, 1),
+        }
@@ -0,0 +1,112 @@
+import threading
+import numpy as np
+
+
+class SttStream:
+    # transcribes one utterance while it is spoken: the uncommitted window is
+    # re-decoded on a worker thread as audio arrives, segments two successive
+    # hypotheses agree on are committed and cut from the window, so at the
+    # end only the unstable tail is left to decode
+    def __init__(self, stt, on_partial=None):
+        self.stt = stt
+        self.on_partial = on_partial
+        self.samplerate = stt.samplerate
+        self.interval_samples = int(stt.stream_interval_sec * self.samplerate)
+        self.min_samples = int(stt.stream_min_sec * self.samplerate)
+        self._audio = np.zeros(self.samplerate * 30, dtype=np.float32)
+        self._length = 0
+        self._decoded_length = 0
+        self._committed = 0
+        self._committed_text = ""
+        self._tail_text = ""
+        self._previous = None
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def feed(self, data):
+        # data: pcm16 bytes or int16 samples
+        samples = np.frombuffer(data, np.int16).astype(np.float32) / 32768.0
+        with self._cond:
+            if self._length + len(samples) > len(self._audio):
+                # grow by replacing, the worker may still be decoding a view of the old one
+                audio = np.zeros(
+                    max(2 * len(self._audio), self._length + len(samples)), np.float32
+                )
+                audio[: self._length] = self._audio[: self._length]
+                self._audio = audio
+            self._audio[self._length : self._length + len(samples)] = samples
+            self._length += len(samples)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._stopped
+                    or self._length - self._decoded_length >= self.interval_samples
+                )
+                if self._stopped:
+                    return
+                start, end = self._committed, self._length
+                self._decoded_length = end
+                window = self._audio[start:end]
+            if end - start < self.min_samples:
+                continue
+            segments = self.stt.transcribe_segments(window)
+            with self._cond:
+                if self._stopped:
+                    return
+                self._agree(start, segments)
+                partial = self._committed_text + self._tail_text
+            if self.on_partial is not None:
+                self.on_partial(partial.strip())
+
+    def _agree(self, start, segments):
+        # the last segment may still be growing, never commit it
+        stable = 0
+        if self._previous is not None:
+            for i, (text, _, end) in enumerate(segments[:-1]):
+                if (
+                    i < len(self._previous)
+                    and text.strip() == self._previous[i].strip()
+                    and end is not None
+                ):
+                    stable = i + 1
+                else:
+                    break
+        if stable > 0:
+            self._committed_text += "".join(text for text, _, _ in segments[:stable])
+            self._committed = start + int(segments[stable - 1][2] * self.samplerate)
+        self._previous = [text for text, _, _ in segments[stable:]]
+        self._tail_text = "".join(self._previous)
+
+    def finish(self, cut_samples=0, trim=None):
+        # decode what is left, without the trailing cut_samples of silence; the
+        # tail goes the way of a whole recording: trim, then no timestamps so
+        # it takes the fast path. Returns the transcript and its confidence
+        self.close()
+        end = max(self._length - cut_samples, 0)
+        if end <= self.stt.window_samples:
+            # one whisper window costs the same whatever is in it, so a short
+            # utterance is decoded whole and its confidence covers the turn
+            start, committed_text = 0, ""
+        else:
+            start, committed_text = min(self._committed, end), self._committed_text
+        tail = self._audio[start:end]
+        if trim is not None and len(tail) > 0:
+            tail = trim(tail)
+        tail_text, confidence = "", None
+        if len(tail) > 0:
+            tail_text, confidence = self.stt.transcribe_translate(tail, return_confidence=True)
+        if committed_text:
+            # committed segments were speech, a noisy tail doesn't drop the turn
+            confidence = None
+        return (committed_text + " " + tail_text).strip(), confidence
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._worker.join()
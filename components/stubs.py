@@ -0,0 +1,127 @@
+import time
+import threading
+import numpy as np
+from .answer_sender import AnswerSender
+
+# stand-ins for Stt, Llm and Tts with the same interface, no models needed;
+# they hold their lock and sleep for a configurable model time, so server.py
+# can be load tested on any machine (python server.py --stub)
+
+
+class StubStt:
+    def __init__(self, params=None):
+        self.params = params or {}
+        self.samplerate = self.params.get("stt_samplerate", None) or 16000
+        self.window_samples = self.samplerate * 30
+        self.rtf = self.params.get("stt_rtf", None) or 0
+        self.transcript = self.params.get("stt_transcript", None) or "Hello Aria."
+        self.streaming = self.params.get("stt_streaming", None)
+        self.stream_interval_sec = 1.0
+        self.stream_min_sec = 1.0
+        self.lock = threading.Lock()
+
+    def transcribe_batch(self, batch, timestamps=True):
+        # a batch costs about as much as its longest utterance
+        with self.lock:
+            time.sleep(max(len(data) for data in batch) / self.samplerate * self.rtf)
+        return [
+            {
+                "text": " " + self.transcript,
+                "chunks": [
+                    {"text": " " + self.transcript, "timestamp": (0.0, len(data) / self.samplerate)}
+                ],
+            }
+            for data in batch
+        ]
+
+    def transcribe_translate(self, data, return_confidence=False):
+        text = self.transcribe_batch([data], timestamps=False)[0]["text"][1:]
+        if return_confidence:
+            return text, None
+        return text
+
+    def check_confidence(self, confidence):
+        return True
+
+    def transcribe_segments(self, data):
+        return [
+            (chunk["text"], *chunk["timestamp"])
+            for chunk in self.transcribe_batch([data])[0]["chunks"]
+        ]
+
+
+class StubLlm:
+    def __init__(self, params=None):
+        self.params = params or {}
+        self.streaming_output = self.params.get("streaming_output", None)
+        self.system_message = self.params.get("system_message", None)
+        self.tokens_per_sec = self.params.get("llm_tokens_per_sec", None) or 50
+        self.answer = self.params.get("llm_answer", None) or "This is a stub answer."
+        self.user_aware_messages = {}
+        self.lock = threading.Lock()
+
+    def interrupt_background(self):
+        pass
+
+    def reset(self, user):
+        with self.lock:
+            self.user_aware_messages.pop(user, None)
+
+    def get_answer(self, nw, tts, data, user):
+        sender = AnswerSender(nw, tts)
+        try:
+            with self.lock:
+                if user not in self.user_aware_messages:
+                    self.user_aware_messages[user] = [
+                        {"role": "system", "content": self.system_message}
+                    ]
+                self.user_aware_messages[user].append({"role": "user", "content": data})
+                tokens = [word + " " for word in self.answer.split(" ")]
+                if self.streaming_output:
+                    sentence = []
+                    for token in tokens:
+                        time.sleep(1 / self.tokens_per_sec)
+                        sender.send_token(token, False)
+                        sentence.append(token)
+                        if token.rstrip()[-1:] in [".", "!", "?", ":"]:
+                            sender.run_tts("".join(sentence).strip())
+                            sentence = []
+                    if sentence:
+                        sender.run_tts("".join(sentence).strip())
+                    sender.send_streaming_end()
+                else:
+                    time.sleep(len(tokens) / self.tokens_per_sec)
+                llm_output = self.answer
+                self.user_aware_messages[user].append(
+                    {"role": "assistant", "content": llm_output}
+                )
+        finally:
+            sender.close()
+        return llm_output
+
+
+class StubTts:
+    def __init__(self, params=None):
+        self.params = params or {}
+        self.tts_type = "stub"
+        self.text_splitting = False
+        self.samplerate = self.params.get("tts_samplerate", None) or 24000
+        self.rtf = self.params.get("tts_rtf", None) or 0
+        self.sec_per_char = self.params.get("tts_sec_per_char", None) or 0.06
+        self.chunk_sec = self.params.get("tts_chunk_sec", None) or 0.5
+        self.lock = threading.Lock()
+
+    def run_tts(self, nw, data):
+        with self.lock:
+            n_samples = int(len(data) * self.sec_per_char * self.samplerate)
+            chunk_samples = int(self.chunk_sec * self.samplerate)
+            # a quiet tone, so compressed runs encode something realistic
+            tone = (
+                np.sin(2 * np.pi * 220 * np.arange(n_samples) / self.samplerate) * 3000
+            ).astype(np.int16)
+            for start in range(0, n_samples, chunk_samples):
+                chunk = tone[start : start + chunk_samples]
+                time.sleep(len(chunk) / self.samplerate * self.rtf)
+                nw.send_tts_audio(chunk.tobytes())
+        nw.send_tts_end()
+        return "tts_done"
@@ -0,0 +1,123 @@
+import time
+import threading
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below in a few sentences, in its language. Keep "
+    "names, facts, decisions and open questions, drop small talk."
+)
+
+
+class Summarizer:
+    # condenses the older turns of a conversation into one pinned summary message
+    # while the llm is idle, then prefills the shorter prompt so the next turn
+    # only evaluates its own message. Prompts are evaluated a message (or a
+    # transcript line) at a time and any activity cancels the work between two
+    # of them or two generated tokens; the llm cache is then put back as it
+    # was and the work is retried at the next idle period.
+    # llm is llm.Llm or llm_server.Llm: lock, get_context, save_cache,
+    # restore_cache, evaluate, generate_summary, prefill
+    def __init__(self, llm, params=None):
+        self.params = params or {}
+        self.summarize_after_turns = self.params.get("summarize_after_turns", None) or 0
+        self.summarize_min_tokens = self.params.get("summarize_min_tokens", None) or 0
+        self.summarize_keep_turns = self.params.get("summarize_keep_turns", None) or 2
+        self.summary_tokens = self.params.get("summary_tokens", None) or 256
+        self.summarize_idle_sec = self.params.get("summarize_idle_sec", None) or 2.0
+        self.summary_prompt = self.params.get("summary_prompt", None) or SUMMARY_PROMPT
+        self.llm = llm
+        self.pending = set()
+        self.activity = 0
+        self.last_activity = time.monotonic()
+        self.cond = threading.Condition()
+        self.summaries = 0
+        self.cancelled = 0
+        self.removed_tokens = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def interrupt(self):
+        # a request or an utterance is coming, give the llm back
+        with self.cond:
+            self.activity += 1
+            self.last_activity = time.monotonic()
+
+    def turn_finished(self, key):
+        with self.cond:
+            self.pending.add(key)
+            self.last_activity = time.monotonic()
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                idle = time.monotonic() - self.last_activity
+                if idle < self.summarize_idle_sec:
+                    self.cond.wait(self.summarize_idle_sec - idle)
+                    continue
+                key = next(iter(self.pending))
+                activity = self.activity
+            with self.llm.lock:
+                done = self._summarize(key, lambda: self.activity != activity)
+            if done:
+                with self.cond:
+                    self.pending.discard(key)
+
+    def _due(self, context):
+        return (self.summarize_after_turns and context.turns() > self.summarize_after_turns) or (
+            self.summarize_min_tokens and context.tokens > self.summarize_min_tokens
+        )
+
+    def _cancel(self, saved):
+        self.llm.restore_cache(saved)
+        self.cancelled += 1
+        return False
+
+    def _summarize(self, key, cancelled):
+        # True when done or nothing to do, False when cancelled
+        context = self.llm.get_context(key)
+        if cancelled():
+            self.cancelled += 1
+            return False
+        if context is None or not self._due(context):
+            return True
+        indices = context.summarizable(self.summarize_keep_turns)
+        if not indices:
+            return True
+        lines = []
+        if context.summary is not None:
+            lines.append("Earlier: " + context.summary)
+        for index in indices:
+            message = context.messages[index]
+            lines.append(("User: " if message["role"] == "user" else "Aria: ") + message["content"])
+        # each prompt extends the previous one by a line
+        prompts = [
+            [
+                {"role": "system", "content": self.summary_prompt},
+                {"role": "user", "content": "\n".join(lines[:end])},
+            ]
+            for end in range(1, len(lines) + 1)
+        ]
+        saved = self.llm.save_cache()
+        if not self.llm.evaluate(prompts, cancelled):
+            return self._cancel(saved)
+        summary = ""
+        for text in self.llm.generate_summary(prompts[-1], self.summary_tokens):
+            if cancelled():
+                return self._cancel(saved)
+            summary += text
+        tokens = context.tokens
+        context.summarize(indices, summary.strip())
+        self.summaries += 1
+        self.removed_tokens += tokens - context.tokens
+        print(
+            f"Summary: {len(indices)} messages condensed, prompt {tokens} -> {context.tokens}"
+            f" tokens, {self.removed_tokens} removed in {self.summaries} summaries"
+        )
+        # cancelled or not, the cache now holds a prefix of the new prompt
+        self.llm.prefill(
+            key,
+            [context.messages[:end] for end in range(1, len(context.messages) + 1)],
+            cancelled,
+        )
+        return True
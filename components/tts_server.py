@@ -1,5 +1,6 @@
 import os
 import warnings
+import threading
 import numpy as np
 from trainer.io import get_user_data_dir
 from TTS.utils.manage import ModelManager
@@ -53,7 +54,13 @@ class Tts:
         elif self.tts_type == "kokoro":
             self.pipeline = KPipeline(lang_code='a')
 
+        self.lock = threading.Lock()
+
     def run_tts(self, nw, data):
+        with self.lock:
+            return self._run_tts(nw, data)
+
+    def _run_tts(self, nw, data):
         if not all(char.isspace() for char in data):
             if self.tts_type == "coqui":
                 tts_stream = self.model.inference_stream(
@@ -77,7 +84,6 @@ class Tts:
                     chunk = chunk.cpu()
                 # maybe clip first? np.clip(chunk.numpy(), -1.0, 1.0)
                 chunk_numpy_int16 = (chunk.numpy() * 32768).astype(np.int16)
-                nw.send_msg("tts_continue")
-                nw.send_audio_recording(chunk_numpy_int16.tobytes())
-        nw.send_msg("tts_end")
+                nw.send_tts_audio(chunk_numpy_int16.tobytes())
+        nw.send_tts_end()
         return "tts_done"
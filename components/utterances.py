@@ -0,0 +1,35 @@
+import os
+import wave
+from os.path import join
+import numpy as np
+
+# pcm16 recordings shared by loadgen.py and bench_stt.py
+
+
+def load_utterances(paths, samplerate):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".wav")
+            )
+        else:
+            files.append(path)
+    utterances = []
+    for file in files:
+        with wave.open(file, "rb") as wav:
+            if wav.getsampwidth() != 2:
+                raise ValueError(f"{file}: only 16 bit wav is supported")
+            data = np.frombuffer(wav.readframes(wav.getnframes()), np.int16)
+            data = data.reshape(-1, wav.getnchannels()).mean(axis=1)
+            if wav.getframerate() != samplerate:
+                n_samples = int(len(data) * samplerate / wav.getframerate())
+                data = np.interp(
+                    np.linspace(0, len(data) - 1, n_samples), np.arange(len(data)), data
+                )
+        utterances.append(data.astype(np.int16).tobytes())
+    if not utterances:
+        # two seconds of noise when no recordings are given
+        rng = np.random.default_rng(0)
+        utterances.append((rng.standard_normal(samplerate * 2) * 1000).astype(np.int16).tobytes())
+    return utterances
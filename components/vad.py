@@ -1,3 +1,5 @@
+from collections import deque
+import numpy as np
 import torch
 import onnxruntime as ort
 
@@ -13,6 +15,35 @@ class Vad:
         self.no_voice_wait_sec = self.params.get("no_voice_wait_sec", None)
         self.onnx_verbose = self.params.get("onnx_verbose", None)
         self.verbose = self.params.get("verbose", None)
+        self.trim_silence = self.params.get("trim_silence", None)
+        self.trim_pad_ms = self.params.get("trim_pad_ms", None) or 200
+        self.trim_min_silence_ms = self.params.get("trim_min_silence_ms", None) or 300
+        # windows clearly below the noise floor skip silero while nobody speaks
+        self.energy_gate = self.params.get("energy_gate", None)
+        self.energy_gate_ratio = self.params.get("energy_gate_ratio", None) or 2.0
+        self.energy_floor_min = self.params.get("energy_floor_min", None) or 0.0005
+        self.noise_floor_alpha = self.params.get("noise_floor_alpha", None) or 0.05
+        # the floor starts at a low percentile of the first windows, any of them
+        # may already be speech; it then only follows windows silero heard no
+        # speech in, and one window in noise_floor_probe_windows skips the gate
+        # so a quieter room still lowers it
+        self.noise_floor_seed_windows = self.params.get("noise_floor_seed_windows", None) or 30
+        self.noise_floor_probe_windows = (
+            self.params.get("noise_floor_probe_windows", None) or 32
+        )
+        self.energy_lookback = self.params.get("energy_lookback", None) or 3
+        # the wait before the end of a turn follows the speaker's own pauses and
+        # the partial transcript, between endpoint_min_sec and endpoint_max_sec
+        self.endpoint_adaptive = self.params.get("endpoint_adaptive", None)
+        self.endpoint_min_sec = self.params.get("endpoint_min_sec", None) or 0.3
+        self.endpoint_max_sec = (
+            self.params.get("endpoint_max_sec", None) or self.no_voice_wait_sec * 1.5
+        )
+        self.endpoint_min_pauses = self.params.get("endpoint_min_pauses", None) or 5
+        self.endpoint_final_factor = self.params.get("endpoint_final_factor", None) or 0.6
+        self.endpoint_continue_factor = (
+            self.params.get("endpoint_continue_factor", None) or 1.5
+        )
 
         if self.use_onnx and not self.onnx_verbose:
             ort.set_default_logger_severity(3)
@@ -35,36 +66,194 @@ class Vad:
         ) = self.silero_utils
 
         self.no_voice_sec = 0
+        # silence at the end of the last turn, to cut it from the recording
+        self.end_silence_sec = self.no_voice_wait_sec
+        self.hangover_sec = self.no_voice_wait_sec
+        # pauses within turns, the speaker resumed after them
+        self.pauses = deque(maxlen=50)
+        self.transcript = ""
+        self.threshold = 0.5
+        self.min_silence_samples = self.samplerate * 100 // 1000
+
+        # silero only takes exact windows: 512 samples at 16k, 256 at 8k;
+        # mic buffers of any size are cut into them, the rest waits for the next one
+        self.window_samples = 512 if self.samplerate == 16000 else 256
+        self.context_samples = 64 if self.samplerate == 16000 else 32
+        self.window_time = self.window_samples / self.samplerate
 
-        self.vad_iterator = self.VADIterator(
+        # with onnx the session is called directly on numpy windows, skipping
+        # the torch wrapper; the state layout is the one of silero v5
+        self.session = getattr(self.silero_vad_model, "session", None)
+        if self.session is not None and "state" not in [
+            node.name for node in self.session.get_inputs()
+        ]:
+            self.session = None
+        self.sr = np.array(self.samplerate, dtype=np.int64)
+        self.noise_floor = None
+        self.seed_rms = []
+        self.skipped_in_row = 0
+        self.windows_total = 0
+        self.windows_skipped = 0
+        self.reset_vad()
+
+    def trim(self, audio):
+        # keep only the speech regions of a float32 recording, each padded by
+        # trim_pad_ms; pauses shorter than trim_min_silence_ms are kept as is
+        audio_tensor = torch.from_numpy(audio)
+        speech_timestamps = self.get_speech_timestamps(
+            audio_tensor,
             self.silero_vad_model,
-            threshold=0.5,
             sampling_rate=self.samplerate,
-            min_silence_duration_ms=100,
-            speech_pad_ms=30,
+            min_silence_duration_ms=self.trim_min_silence_ms,
+            speech_pad_ms=self.trim_pad_ms,
+        )
+        # the model state is shared with check() when not using the session
+        self.silero_vad_model.reset_states()
+        if speech_timestamps:
+            trimmed = self.collect_chunks(speech_timestamps, audio_tensor).numpy()
+        else:
+            trimmed = audio[:0]
+        print(
+            f"VAD trim: removed {(len(audio) - len(trimmed)) / self.samplerate:.2f} s"
+            f" of {len(audio) / self.samplerate:.2f} s"
         )
+        return trimmed
 
     def reset_vad(self):
         self.no_voice_sec = 0
-        self.vad_iterator.reset_states()
+        self.triggered = False
+        self.temp_end = 0
+        self.current_sample = 0
+        self.status = "None"
+        self.transcript = ""
+        self.hangover_sec = self.no_voice_wait_sec
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.state = np.zeros((2, 1, 128), dtype=np.float32)
+        self.context = np.zeros(self.context_samples, dtype=np.float32)
+        # skipped windows silero sees before the next one that passes the gate,
+        # so its state has the onset of the speech
+        self.lookback = deque(maxlen=self.energy_lookback + 1)
+        self.silero_vad_model.reset_states()
 
-    def check(self, mic_chunk, chunk_time):
-        speech_dict = self.vad_iterator(
-            mic_chunk[64:576],  # TODO grab target buffer size from mic
-            return_seconds=False,  # can only do 256 8k or 512 for 16k, mid should be good?
+    def speech_probs(self, windows):
+        if self.session is None:
+            return [
+                self.silero_vad_model(torch.from_numpy(window), self.samplerate).item()
+                for window in windows
+            ]
+        # the windows follow each other through the recurrent state, so one
+        # run per window, but without any torch round trip
+        probs = []
+        for window in windows:
+            x = np.concatenate((self.context, window))[np.newaxis]
+            prob, self.state = self.session.run(
+                None, {"input": x, "state": self.state, "sr": self.sr}
+            )
+            self.context = x[0, -self.context_samples :]
+            probs.append(prob[0, 0])
+        return probs
+
+    def speech_event(self, speech_prob):
+        # same rules as silero's VADIterator
+        self.current_sample += self.window_samples
+        if speech_prob >= self.threshold and self.temp_end:
+            self.temp_end = 0
+        if speech_prob >= self.threshold and not self.triggered:
+            self.triggered = True
+            return "start"
+        if speech_prob < self.threshold - 0.15 and self.triggered:
+            if not self.temp_end:
+                self.temp_end = self.current_sample
+            if self.current_sample - self.temp_end >= self.min_silence_samples:
+                self.temp_end = 0
+                self.triggered = False
+                return "end"
+        return None
+
+    def check(self, mic_chunk):
+        self.pending = np.concatenate((self.pending, np.asarray(mic_chunk, np.float32)))
+        n_windows = len(self.pending) // self.window_samples
+        if n_windows == 0:
+            return self.status
+        windows = self.pending[: n_windows * self.window_samples].reshape(
+            n_windows, self.window_samples
         )
-        if speech_dict is not None:
-            if "start" in speech_dict:
-                self.no_voice_sec = 0
-            elif "end" in speech_dict:
-                self.no_voice_sec += chunk_time
+        self.pending = self.pending[n_windows * self.window_samples :]
+        window_rms = np.sqrt(np.mean(np.square(windows), axis=1))
+        for window, rms in zip(windows, window_rms):
+            self.windows_total += 1
+            if self.noise_floor is None:
+                self.seed_rms.append(float(rms))
+                if len(self.seed_rms) == self.noise_floor_seed_windows:
+                    self.noise_floor = float(np.percentile(self.seed_rms, 10))
+            self.lookback.append(window)
+            if (
+                self.energy_gate
+                and self.noise_floor is not None
+                and not self.triggered
+                and self.no_voice_sec == 0
+                and self.skipped_in_row < self.noise_floor_probe_windows
+                and rms < max(self.noise_floor * self.energy_gate_ratio, self.energy_floor_min)
+            ):
+                self.windows_skipped += 1
+                self.skipped_in_row += 1
+                speech_prob = 0.0
+            else:
+                self.skipped_in_row = 0
+                speech_prob = self.speech_probs(self.lookback)[-1]
+                self.lookback.clear()
+                if (
+                    self.noise_floor is not None
+                    and not self.triggered
+                    and speech_prob < self.threshold
+                ):
+                    self.noise_floor += self.noise_floor_alpha * (rms - self.noise_floor)
+            self.status = self.update(self.speech_event(speech_prob))
+            if self.status == "vad_end":
+                self.reset_vad()
+                return "vad_end"
+        return self.status
+
+    def gate_stats(self):
+        return {
+            "skip_ratio": round(self.windows_skipped / max(self.windows_total, 1), 3),
+            "windows": self.windows_total,
+            "noise_floor": round(float(self.noise_floor or 0), 5),
+        }
+
+    def set_transcript(self, text):
+        # partial transcript of the turn, a hint for the endpointer
+        self.transcript = text
+
+    def hangover(self):
+        if not self.endpoint_adaptive:
+            return self.no_voice_wait_sec
+        wait = self.no_voice_wait_sec
+        if len(self.pauses) >= self.endpoint_min_pauses:
+            # longer than nearly all the pauses this speaker makes mid turn
+            wait = float(np.percentile(self.pauses, 90)) * 1.2
+        text = self.transcript.rstrip()
+        if text.endswith(("...", "…", ",", ";", ":")):
+            wait *= self.endpoint_continue_factor
+        elif text.endswith((".", "?", "!")):
+            wait *= self.endpoint_final_factor
+        return min(max(wait, self.endpoint_min_sec), self.endpoint_max_sec)
+
+    def update(self, speech_event):
+        # chunk time is the time of the window actually analysed
+        if speech_event == "start":
+            if self.no_voice_sec != 0:
+                self.pauses.append(self.no_voice_sec)
+            self.no_voice_sec = 0
+        elif speech_event == "end":
+            self.no_voice_sec += self.window_time
         else:
             if self.no_voice_sec != 0:
-                self.no_voice_sec += chunk_time
-                if self.no_voice_sec > self.no_voice_wait_sec:
-                    self.no_voice_sec = 0
-                    self.vad_iterator.reset_states()
+                self.no_voice_sec += self.window_time
+                self.hangover_sec = self.hangover()
+                if self.no_voice_sec > self.hangover_sec:
+                    self.end_silence_sec = self.no_voice_sec
                     return "vad_end"
-            elif not self.vad_iterator.triggered:
+            elif not self.triggered:
                 return "None"
         return "vad_continue"
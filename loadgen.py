@@ -0,0 +1,181 @@
+import argparse
+import json
+import time
+import threading
+from os.path import join
+import numpy as np
+from components.nw import Nw
+from components.nw import OP_STT_TRANSCRIBE
+from components.nw import OP_STT_RESULT
+from components.nw import OP_LLM_TOKEN
+from components.nw import OP_LLM_ANSWER
+from components.nw import OP_STREAMING_END
+from components.nw import OP_TTS_AUDIO
+from components.nw import OP_TTS_END
+from components.nw import FLAG_AUTO_ANSWER
+from components.utterances import load_utterances
+
+# simulated clients against a running server.py, usually started with --stub:
+# python server.py --stub
+# python loadgen.py --clients 8 --turns 5 --wav recordings/
+
+STAGES = ["connect", "upload", "stt", "first_token", "first_audio", "turn"]
+
+
+def load_config(config_file):
+    with open(config_file, "r") as file:
+        json_data = json.load(file)
+    return json_data
+
+
+def run_turn(nw, utterance, stats):
+    start = time.perf_counter()
+    nw.send_frame(OP_STT_TRANSCRIBE, flags=FLAG_AUTO_ANSWER)
+    nw.send_audio_recording(utterance)
+    uploaded = time.perf_counter()
+    stats.record("upload", uploaded - start)
+    answered = False
+    first_token = first_audio = None
+    while True:
+        opcode, flags, payload = nw.receive_frame()
+        now = time.perf_counter()
+        if opcode == OP_STT_RESULT:
+            stats.record("stt", now - uploaded)
+            if len(payload) == 1:
+                # skipped or deleted, no answer follows
+                break
+        elif opcode in (OP_LLM_TOKEN, OP_LLM_ANSWER):
+            answered = answered or opcode == OP_LLM_ANSWER
+            if first_token is None:
+                first_token = now
+                stats.record("first_token", now - uploaded)
+        elif opcode == OP_TTS_AUDIO:
+            stats.add_audio(len(nw.decode_audio(payload)))
+            if first_audio is None:
+                first_audio = now
+                stats.record("first_audio", now - uploaded)
+        elif (opcode == OP_TTS_END and answered) or opcode == OP_STREAMING_END:
+            break
+    stats.record("turn", time.perf_counter() - start)
+    stats.add_turn()
+
+
+def run_client(index, args, nw_params, mic_params, ap_params, utterances, stats):
+    nw = Nw(params=nw_params)
+    start = time.perf_counter()
+    result = nw.client_connect(
+        args.host or nw_params.get("client_target_ip", None),
+        args.port or nw_params.get("client_target_port", None),
+        args.username or nw_params.get("username", None),
+        args.password or nw_params.get("password", None),
+    )
+    if result != "success":
+        stats.error(result)
+        return
+    stats.record("connect", time.perf_counter() - start)
+    if nw.audio_compression:
+        nw.init_audio_encoder(
+            mic_params.get("samplerate"),
+            mic_params.get("channels"),
+            mic_params.get("buffer_size"),
+        )
+        nw.init_audio_decoder(
+            ap_params.get("samplerate"),
+            ap_params.get("channels"),
+            ap_params.get("buffer_size"),
+        )
+    try:
+        for turn in range(args.turns):
+            nw.send_heartbeat()
+            run_turn(nw, utterances[(index + turn) % len(utterances)], stats)
+            time.sleep(args.think_sec)
+        nw.send_bye()
+    except (OSError, ConnectionError) as e:
+        stats.error(type(e).__name__)
+    finally:
+        nw.close_connection()
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {stage: [] for stage in STAGES}
+        self.errors = {}
+        self.turns = 0
+        self.audio_bytes = 0
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.latencies[stage].append(seconds)
+
+    def add_turn(self):
+        with self.lock:
+            self.turns += 1
+
+    def add_audio(self, n_bytes):
+        with self.lock:
+            self.audio_bytes += n_bytes
+
+    def error(self, kind):
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def report(self, elapsed, samplerate):
+        print(f"{'stage':<12}{'n':>6}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for stage in STAGES:
+            values = np.array(self.latencies[stage]) * 1000
+            if len(values) == 0:
+                continue
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            print(
+                f"{stage:<12}{len(values):>6}{p50:>10.0f}{p90:>10.0f}{p99:>10.0f}{values.max():>10.0f}"
+            )
+        audio_sec = self.audio_bytes / 2 / samplerate
+        print(
+            f"{self.turns} turns in {elapsed:.1f} s: {self.turns / elapsed:.2f} turns/s,"
+            f" {audio_sec / elapsed:.2f} s of speech received per s"
+        )
+        print("Errors:", self.errors or "none")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aria load generator.")
+    parser.add_argument(
+        "--config",
+        default="default.json",
+        help="Path to JSON config file in the configs folder",
+    )
+    parser.add_argument("--clients", type=int, default=4, help="Simulated clients")
+    parser.add_argument("--turns", type=int, default=5, help="Turns per client")
+    parser.add_argument("--wav", nargs="*", default=[], help="Wav files or folders to upload")
+    parser.add_argument("--ramp-sec", type=float, default=1.0, help="Spread client starts over")
+    parser.add_argument("--think-sec", type=float, default=0.5, help="Pause between turns")
+    parser.add_argument("--host", help="Server ip, default client_target_ip")
+    parser.add_argument("--port", type=int, help="Server port, default client_target_port")
+    parser.add_argument("--username", help="Default username from the Nw config")
+    parser.add_argument("--password", help="Default password from the Nw config")
+    args = parser.parse_args()
+
+    config = load_config(join("configs", args.config))
+    nw_params = config.get("Nw", {}).get("params", {})
+    mic_params = config.get("Mic", {}).get("params", {})
+    ap_params = config.get("Ap", {}).get("params", {})
+    # the load generator reads every frame itself, no udp side channel
+    nw_params = {**nw_params, "udp_audio": False}
+
+    utterances = load_utterances(args.wav, mic_params.get("samplerate"))
+    stats = Stats()
+    clients = []
+    start = time.perf_counter()
+    for index in range(args.clients):
+        client = threading.Thread(
+            target=run_client,
+            args=(index, args, nw_params, mic_params, ap_params, utterances, stats),
+            daemon=True,
+        )
+        client.start()
+        clients.append(client)
+        time.sleep(args.ramp_sec / args.clients)
+    for client in clients:
+        client.join()
+    stats.report(time.perf_counter() - start, ap_params.get("samplerate"))
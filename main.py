@@ -7,10 +7,10 @@ import json
 import time
 import threading
 import numpy as np
-from copy import deepcopy
 from os.path import join
 from components.vad import Vad
 from components.stt import Stt
+from components.stt_stream import SttStream
 from components.llm import Llm
 from components.tts import Tts
 from components.ap import Ap
@@ -52,118 +52,143 @@ def main(ui, config):
     mic = Mic(params=mic_params, ui=ui, vad=vad)
 
     mic_muted = False
-    mic_last_chunk = None
+    stt_stream = None
+    stt_fed = 0
+
+    def show_partial(text):
+        # the endpointer waits less after a finished sentence
+        vad.set_transcript(text)
+        print("\r🎙...", text, end="", flush=True)
+
     ap.play_sound(ap.listening_sound)
     ui.load_visual("You")
     ui.add_message("system", "\nReady...", new_entry=False)
     print("Ready...\n\n🎙...", end=" ")
     mic.start_mic()
     while True:
-        skip_sleep = False
         if ui.kill:
             print("\nShutting down...")
+            print("VAD gate:", vad.gate_stats())
+            print("Mic dropped frames:", mic.dropped_frames)
             break
-        mic_chunk = mic.get_chunk()
-        if len(mic_chunk) == mic.buffer_size * 2:  # 2 bytes per sample when pcm16
-            if max(mic_chunk) == 0 and not mic_muted:
+        # blocks until the mic callback hands over the next buffer
+        mic_frame = mic.get_frame(timeout=0.1)
+        if mic_frame is None:
+            continue
+        mic_samples = mic_frame[1]
+        if not np.any(mic_samples):
+            # every muted frame, or a long mute fills the recording with zeros
+            mic.reset_recording()
+            if not mic_muted:
                 mic_muted = True
                 mic.update_ui = False
                 ui.load_visual("system_muted_mic")
                 vad.reset_vad()
+                if stt_stream is not None:
+                    stt_stream.close()
+                    stt_stream = None
+        else:
+            if mic_muted:
+                ui.load_visual("You")
+                mic.update_ui = True
+                mic_muted = False
+            mic.vad_time = vad.hangover_sec - vad.no_voice_sec
+            vad_status = vad.check(mic_samples)
+            if vad_status == "None":
                 mic.reset_recording()
-                skip_sleep = True
-            elif not (
-                mic_chunk == mic_last_chunk
-            ):  # .all() and max(mic_chunk) != 0: TODO
-                if mic_muted:
-                    ui.load_visual("You")
-                    mic.update_ui = True
-                    mic_muted = False
-                mic_last_chunk = deepcopy(mic_chunk)
-                mic.vad_time = vad.no_voice_wait_sec - vad.no_voice_sec
-                chunk_time = mic_params.get("buffer_size", None) / mic_params.get(
-                    "samplerate", None
-                )
-                vad_status = vad.check(
-                    np.frombuffer(mic_chunk, np.int16)
-                    .flatten()
-                    .astype(np.float32, order="C")
-                    / 32768.0,
-                    chunk_time,
-                )
-                if vad_status is None:
-                    mic.reset_recording()
-                    skip_sleep = True
-                elif vad_status == "vad_end":
-                    mic.stop_mic()
-                    ui.load_visual("system_transition")
-                    ap.play_sound(ap.transition_sound)
-                    mic_recording = mic.get_recording()
-                    mic_recording = mic_recording[
-                        : -vad.no_voice_wait_sec
-                        * (mic.samplerate * 2)  # 2 bytes per sample when pcm16
-                    ]
-                    # wf.write('test.wav', mic.samplerate, mic_recording)
-                    stt_data = stt.transcribe_translate(
-                        np.frombuffer(mic_recording, np.int16)
-                        .flatten()
-                        .astype(np.float32, order="C")
-                        / 32768.0
+                if stt_stream is not None:
+                    stt_stream.close()
+                    stt_stream = None
+            else:
+                # the user is speaking, the llm is needed soon
+                llm.interrupt_background()
+            if vad_status == "vad_end":
+                mic.stop_mic()
+                ui.load_visual("system_transition")
+                ap.play_sound(ap.transition_sound)
+                cut_samples = int(vad.end_silence_sec * mic.samplerate)
+                if stt_stream is not None:
+                    # most of it is already transcribed, only the tail is left
+                    stt_stream.feed(mic.get_recording_from(stt_fed))
+                    stt_data, confidence = stt_stream.finish(
+                        cut_samples, vad.trim if vad.trim_silence else None
                     )
-                    if check_delete_messages(stt_data):
-                        llm.messages = [llm.messages[0]]
-                        stt_data = "d"
-                    elif check_skip_message(stt_data):
+                    stt_stream = None
+                    if not stt_data or not stt.check_confidence(confidence):
+                        # no speech left or most likely noise, no llm turn for it
                         stt_data = "s"
-                    if len(stt_data) != 1:
-                        ui.add_message("You", stt_data, new_entry=True)
-                        print("You:", stt_data)
-                        print("🤖...", end=" ")
-                        llm_data = llm.get_answer(ui, ap, tts, stt_data)
-                        if not llm.streaming_output:
-                            print("Aria:", llm_data)
-                            code_blocks = find_code_blocks(llm_data)
-                            if len(code_blocks) > 0:
-                                color_code_block = True
-                            else:
-                                color_code_block = False
-                            ui.add_message(
-                                "Aria",
-                                llm_data,
-                                new_entry=True,
-                                color_code_block=color_code_block,
-                                code_blocks=code_blocks,
-                            )
-                            if tts.tts_type == "coqui":
-                                tts.text_splitting = True
-                            # TODO handle emphasis
-                            # TODO add remove_nonverbal_cues when not streaming llm
-                            txt_for_tts = remove_emojis(
-                                remove_multiple_dots(remove_code_blocks(llm_data))
-                            )
-                            if not all(char.isspace() for char in txt_for_tts):
-                                tts.run_tts(txt_for_tts)
-                                ap.check_audio_finished()
+                else:
+                    # wf.write('test.wav', mic.samplerate, mic_recording)
+                    # a copy, trim and stt must not see the mic buffer change under them
+                    stt_input = mic.get_recording_float().copy()
+                    stt_input = stt_input[: max(len(stt_input) - cut_samples, 0)]
+                    if vad.trim_silence:
+                        stt_input = vad.trim(stt_input)
+                    if len(stt_input) > 0:
+                        stt_data, confidence = stt.transcribe_translate(
+                            stt_input, return_confidence=True
+                        )
+                        if not stt.check_confidence(confidence):
+                            # most likely noise, no llm turn for it
+                            stt_data = "s"
                     else:
-                        # TODO add to llm context
-                        ui.add_message("You", "...", new_entry=True)
-                        print("You: ...")
-                        # ui.add_message("Aria", "Did you say something?", new_entry=True)
-                        # print("🤖... Aria:", "Did you say something?")
-                        # tts.run_tts("Did you say something?")
-                        # ap.check_audio_finished()
-                    time.sleep(1)
-                    ap.play_sound(ap.listening_sound)
-                    ui.load_visual("You")
-                    print("\n🎙...", end=" ")
-                    mic.start_mic()
-                    skip_sleep = True
+                        # no speech left, nothing to transcribe
+                        stt_data = "s"
+                if check_delete_messages(stt_data):
+                    llm.reset()
+                    stt_data = "d"
+                elif check_skip_message(stt_data):
+                    stt_data = "s"
+                if len(stt_data) != 1:
+                    ui.add_message("You", stt_data, new_entry=True)
+                    print("You:", stt_data)
+                    print("🤖...", end=" ")
+                    llm_data = llm.get_answer(ui, ap, tts, stt_data)
+                    if not llm.streaming_output:
+                        print("Aria:", llm_data)
+                        code_blocks = find_code_blocks(llm_data)
+                        if len(code_blocks) > 0:
+                            color_code_block = True
+                        else:
+                            color_code_block = False
+                        ui.add_message(
+                            "Aria",
+                            llm_data,
+                            new_entry=True,
+                            color_code_block=color_code_block,
+                            code_blocks=code_blocks,
+                        )
+                        if tts.tts_type == "coqui":
+                            tts.text_splitting = True
+                        # TODO handle emphasis
+                        # TODO add remove_nonverbal_cues when not streaming llm
+                        txt_for_tts = remove_emojis(
+                            remove_multiple_dots(remove_code_blocks(llm_data))
+                        )
+                        if not all(char.isspace() for char in txt_for_tts):
+                            tts.run_tts(txt_for_tts)
+                            ap.check_audio_finished()
                 else:
-                    pass
-            else:
-                pass
-        if not skip_sleep:
-            time.sleep(mic.buffer_size / mic.samplerate)
+                    # TODO add to llm context
+                    ui.add_message("You", "...", new_entry=True)
+                    print("You: ...")
+                    # ui.add_message("Aria", "Did you say something?", new_entry=True)
+                    # print("🤖... Aria:", "Did you say something?")
+                    # tts.run_tts("Did you say something?")
+                    # ap.check_audio_finished()
+                time.sleep(1)
+                ap.play_sound(ap.listening_sound)
+                ui.load_visual("You")
+                print("\n🎙...", end=" ")
+                mic.start_mic()
+            elif stt.streaming:
+                # transcribe while the user is still speaking
+                if stt_stream is None:
+                    stt_stream = SttStream(stt, show_partial)
+                    stt_fed = 0
+                mic_recording = mic.get_recording_from(stt_fed)
+                stt_stream.feed(mic_recording)
+                stt_fed += len(mic_recording)
 
 
 if __name__ == "__main__":
@@ -7,9 +7,20 @@ import json
 from os.path import join
 import numpy as np
 from components.nw import Nw
-from components.stt import Stt
-from components.llm_server import Llm
-from components.tts_server import Tts
+from components.nw import OP_PING
+from components.nw import OP_BYE
+from components.nw import OP_STT_TRANSCRIBE
+from components.nw import OP_STT_RESULT
+from components.nw import OP_MIC_STREAM_START
+from components.nw import OP_MIC_STREAM
+from components.nw import OP_VAD_END
+from components.nw import OP_STT_PARTIAL
+from components.nw import OP_LLM_GET_ANSWER
+from components.nw import OP_LLM_ANSWER
+from components.nw import OP_FIXED_ANSWER
+from components.nw import FLAG_AUTO_ANSWER
+from components.stt_stream import SttStream
+from components.stt_batcher import SttBatcher
 from components.utils import remove_emojis
 from components.utils import remove_nonverbal_cues
 from components.utils import remove_multiple_dots
@@ -26,6 +37,159 @@ def load_config(config_file):
     return json_data
 
 
+def answer(nw, username, stt_data, llm, tts):
+    llm_data = llm.get_answer(nw, tts, stt_data, username)
+    if not llm.streaming_output:
+        nw.send_text(OP_LLM_ANSWER, llm_data)
+        if tts.tts_type == "coqui":
+            tts.text_splitting = True
+        # TODO handle emphasis
+        # TODO add remove_nonverbal_cues when not streaming llm
+        txt_for_tts = remove_emojis(
+            remove_multiple_dots(remove_code_blocks(llm_data))
+        )
+        tts.run_tts(nw, txt_for_tts)
+
+
+def load_vad(vad, vad_params):
+    if vad is None:
+        from components.vad import Vad
+
+        vad = Vad(params=vad_params)
+    return vad
+
+
+def transcribe(nw, username, mic_recording, stt, llm, vad=None):
+    # wf.write(
+    #     "test.wav",
+    #     mic_params.get("samplerate", None),
+    #     np.frombuffer(mic_recording, np.int16).flatten(),
+    # )
+    stt_input = (
+        np.frombuffer(mic_recording, np.int16)
+        .flatten()
+        .astype(np.float32, order="C")
+        / 32768.0
+    )
+    if vad is not None and vad.trim_silence:
+        stt_input = vad.trim(stt_input)
+    if len(stt_input) > 0:
+        stt_data, confidence = stt.transcribe_translate(stt_input, return_confidence=True)
+        if not stt.check_confidence(confidence):
+            # most likely noise, no llm turn for it
+            stt_data = "s"
+    else:
+        # no speech left, nothing to transcribe
+        stt_data = "s"
+    return send_transcript(nw, username, stt_data, llm)
+
+
+def send_transcript(nw, username, stt_data, llm):
+    if check_delete_messages(stt_data):
+        llm.reset(username)
+        stt_data = "d"
+    elif check_skip_message(stt_data):
+        stt_data = "s"
+    nw.send_text(OP_STT_RESULT, stt_data)
+    return stt_data
+
+
+def serve_client(nw, username, stt, llm, tts, vad_params):
+    stt_data = None
+    vad = None
+    listening = False
+    mic_recording = bytearray()
+    stt_stream = None
+    stt_fed = 0
+
+    def send_partial(text):
+        # the endpointer waits less after a finished sentence
+        vad.set_transcript(text)
+        nw.send_text(OP_STT_PARTIAL, text)
+
+    while True:
+        try:
+            opcode, flags, payload = nw.receive_frame()
+        except:
+            opcode = None
+        # print(opcode)
+        if opcode is None or opcode == OP_BYE:
+            print("Client disconnected...")
+            if vad is not None:
+                print("VAD gate:", vad.gate_stats())
+            return
+        if opcode == OP_PING:
+            nw.handle_ping(payload, flags)
+            continue
+        if opcode == OP_STT_TRANSCRIBE:
+            # the recording follows immediately, no ack round trip
+            llm.interrupt_background()
+            mic_recording = nw.receive_audio_recording()
+            if vad_params.get("trim_silence", None):
+                vad = load_vad(vad, vad_params)
+            stt_data = transcribe(nw, username, mic_recording, stt, llm, vad)
+            if flags & FLAG_AUTO_ANSWER and len(stt_data) != 1:
+                answer(nw, username, stt_data, llm, tts)
+        elif opcode == OP_MIC_STREAM_START:
+            # thin client, endpointing runs here on its streamed mic
+            vad = load_vad(vad, vad_params)
+            vad.reset_vad()
+            mic_recording = bytearray()
+            listening = True
+            if stt_stream is not None:
+                stt_stream.close()
+                stt_stream = None
+        elif opcode == OP_MIC_STREAM:
+            if not listening:
+                # still in flight when the last turn ended
+                continue
+            mic_chunk = nw.decode_audio(payload)
+            mic_recording.extend(mic_chunk)
+            mic_chunk = (
+                np.frombuffer(mic_chunk, np.int16).astype(np.float32, order="C")
+                / 32768.0
+            )
+            vad_status = vad.check(mic_chunk)
+            if vad_status == "None":
+                # keep the last second before reset, same as Mic.reset_recording
+                del mic_recording[: -vad.samplerate * 2]  # 2 bytes per sample when pcm16
+                if stt_stream is not None:
+                    stt_stream.close()
+                    stt_stream = None
+                continue
+            # the user is speaking, the llm is needed soon
+            llm.interrupt_background()
+            if stt.streaming:
+                # transcribe while the user is still speaking
+                if stt_stream is None:
+                    stt_stream = SttStream(stt, send_partial)
+                    stt_fed = 0
+                stt_stream.feed(mic_recording[stt_fed:])
+                stt_fed = len(mic_recording)
+            if vad_status == "vad_end":
+                listening = False
+                nw.send_frame(OP_VAD_END)
+                cut_samples = int(vad.end_silence_sec * vad.samplerate)
+                if stt_stream is not None:
+                    stt_data, confidence = stt_stream.finish(
+                        cut_samples, vad.trim if vad.trim_silence else None
+                    )
+                    stt_stream = None
+                    if not stt_data or not stt.check_confidence(confidence):
+                        # no speech left or most likely noise, no llm turn for it
+                        stt_data = "s"
+                    stt_data = send_transcript(nw, username, stt_data, llm)
+                else:
+                    mic_recording = mic_recording[: max(len(mic_recording) - cut_samples * 2, 0)]
+                    stt_data = transcribe(nw, username, mic_recording, stt, llm, vad)
+                if len(stt_data) != 1:
+                    answer(nw, username, stt_data, llm, tts)
+        elif opcode == OP_LLM_GET_ANSWER:
+            answer(nw, username, stt_data, llm, tts)
+        elif opcode == OP_FIXED_ANSWER:
+            tts.run_tts(nw, "Did you say something?")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Aria.")
     parser.add_argument(
@@ -33,24 +197,47 @@ if __name__ == "__main__":
         default="default.json",
         help="Path to JSON config file in the configs folder",
     )
+    parser.add_argument(
+        "--stub",
+        action="store_true",
+        help="Use stub STT/LLM/TTS backends, e.g. to load test with loadgen.py",
+    )
     args = parser.parse_args()
 
     config_path = join("configs", args.config)
     config = load_config(config_path)
 
     nw_params = config.get("Nw", {}).get("params", {})
+    vad_params = config.get("Vad", {}).get("params", {})
     stt_params = config.get("Stt", {}).get("params", {})
     llm_params = config.get("Llm", {}).get("params", {})
     tts_params = config.get("Tts", {}).get("params", {})
     mic_params = config.get("Mic", {}).get("params", {})
     ap_params = config.get("Ap", {}).get("params", {})
+    stub_params = config.get("Stubs", {}).get("params", {})
 
     print("Loading...")
 
     nw = Nw(params=nw_params)
-    stt = Stt(params=stt_params)
-    llm = Llm(params=llm_params)
-    tts = Tts(params=tts_params)
+    if args.stub:
+        from components.stubs import StubStt, StubLlm, StubTts
+
+        stt = StubStt(params=stub_params)
+        # trimming needs the silero model, stubs run without models
+        vad_params = {**vad_params, "trim_silence": False}
+        llm = StubLlm(params={**llm_params, **stub_params})
+        tts = StubTts(params=stub_params)
+    else:
+        from components.stt import Stt
+        from components.llm_server import Llm
+        from components.tts_server import Tts
+
+        stt = Stt(params=stt_params)
+        llm = Llm(params=llm_params)
+        tts = Tts(params=tts_params)
+    if nw.concurrent_server and (stt_params.get("batch_max_size", None) or 1) > 1:
+        # utterances of concurrent sessions share one model call
+        stt = SttBatcher(stt, params=stt_params)
 
     nw.server_init()
     if nw.audio_compression:
@@ -64,48 +251,14 @@ if __name__ == "__main__":
             mic_params.get("channels"),
             mic_params.get("buffer_size"),
         )
-    client_address, username = nw.server_listening()
 
-    while True:
-        try:
-            client_data = nw.receive_msg()
-        except:
-            client_data = False
-        # print(client_data)
-        if not client_data:
-            print("Client disconnected...")
+    def handler(session_nw, username):
+        serve_client(session_nw, username, stt, llm, tts, vad_params)
+
+    if nw.concurrent_server:
+        nw.serve_forever(handler)
+    else:
+        while True:
             client_address, username = nw.server_listening()
-        if client_data == "stt_transcribe":
-            nw.send_ack()
-            mic_recording = nw.receive_audio_recording()
-            # wf.write(
-            #     "test.wav",
-            #     mic_params.get("samplerate", None),
-            #     np.frombuffer(mic_recording, np.int16).flatten(),
-            # )
-            stt_data = stt.transcribe_translate(
-                np.frombuffer(mic_recording, np.int16)
-                .flatten()
-                .astype(np.float32, order="C")
-                / 32768.0
-            )
-            if check_delete_messages(stt_data):
-                llm.user_aware_messages.pop(username, None)
-                stt_data = "d"
-            elif check_skip_message(stt_data):
-                stt_data = "s"
-            nw.send_msg(stt_data)
-        elif client_data == "llm_get_answer":
-            llm_data = llm.get_answer(nw, tts, stt_data, username)
-            if not llm.streaming_output:
-                nw.send_msg(llm_data)
-                if tts.tts_type == "coqui":
-                    tts.text_splitting = True
-                # TODO handle emphasis
-                # TODO add remove_nonverbal_cues when not streaming llm
-                txt_for_tts = remove_emojis(
-                    remove_multiple_dots(remove_code_blocks(llm_data))
-                )
-                tts.run_tts(nw, txt_for_tts)
-        elif client_data == "fixed_answer":
-            tts.run_tts(nw, "Did you say something?")
+            serve_client(nw, username, stt, llm, tts, vad_params)
+            nw.close_connection()
@@ -0,0 +1,189 @@
+import argparse
+import json
+import os
+import sys
+import time
+import queue
+import threading
+from math import gcd
+from os.path import join
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
+from components.stt import Stt
+
+# transcribes an archive of recordings with the Stt config of the server:
+# python transcribe.py recordings/ --output transcripts.jsonl
+# python transcribe.py manifest.txt --output transcripts.jsonl --timestamps
+# rerunning with the same output skips the files already transcribed
+
+AUDIO_EXTENSIONS = (".wav", ".flac", ".ogg", ".mp3")
+
+
+def load_config(config_file):
+    with open(config_file, "r") as file:
+        json_data = json.load(file)
+    return json_data
+
+
+def list_files(inputs):
+    # folders are searched recursively, other files are manifests: one path per
+    # line, or jsonl lines with a "path", relative to the manifest
+    files = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, _, names in sorted(os.walk(path)):
+                files.extend(
+                    join(root, name)
+                    for name in sorted(names)
+                    if name.lower().endswith(AUDIO_EXTENSIONS)
+                )
+        elif path.lower().endswith(AUDIO_EXTENSIONS):
+            files.append(path)
+        else:
+            with open(path, "r") as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    if line.startswith("{"):
+                        line = json.loads(line)["path"]
+                    files.append(join(os.path.dirname(path), line))
+    return files
+
+
+def load_done(output):
+    # files with a result in output; error lines and a line cut off by an
+    # interruption are removed from it, those files are transcribed again
+    done = set()
+    if not os.path.exists(output):
+        return done
+    kept = []
+    rewrite = False
+    with open(output, "r") as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                rewrite = True
+                continue
+            if "text" not in result:
+                rewrite = True
+                continue
+            if not line.endswith("\n"):
+                # complete, but the next result must not be appended onto it
+                line += "\n"
+                rewrite = True
+            done.add(result["path"])
+            kept.append(line)
+    if rewrite:
+        with open(output + ".tmp", "w") as file:
+            file.writelines(kept)
+        os.replace(output + ".tmp", output)
+    return done
+
+
+def load_audio(path, samplerate):
+    data, file_samplerate = sf.read(path, dtype="float32", always_2d=True)
+    data = data.mean(axis=1)
+    if file_samplerate != samplerate:
+        divisor = gcd(samplerate, file_samplerate)
+        data = resample_poly(data, samplerate // divisor, file_samplerate // divisor)
+    return np.ascontiguousarray(data, dtype=np.float32)
+
+
+def decode_files(paths, decoded, samplerate):
+    # worker: decodes and resamples while the model transcribes the last batch
+    while True:
+        try:
+            path = paths.get_nowait()
+        except queue.Empty:
+            decoded.put(None)
+            return
+        try:
+            decoded.put((path, load_audio(path, samplerate), None))
+        except Exception as e:
+            decoded.put((path, None, f"{type(e).__name__}: {e}"))
+
+
+def write_results(file, stt, batch, timestamps):
+    outputs = stt.transcribe_batch([audio for _, audio in batch], timestamps=timestamps)
+    for (path, audio), output in zip(batch, outputs):
+        result = {
+            "path": path,
+            "duration": round(len(audio) / stt.samplerate, 3),
+            "text": output["text"][1:],
+        }
+        if timestamps:
+            result["segments"] = [
+                {"text": chunk["text"], "start": chunk["timestamp"][0], "end": chunk["timestamp"][1]}
+                for chunk in output.get("chunks", [])
+            ]
+        if output.get("confidence", None) is not None:
+            result["confidence"] = output["confidence"]
+        file.write(json.dumps(result, ensure_ascii=False) + "\n")
+    file.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aria batch transcription.")
+    parser.add_argument("inputs", nargs="+", help="Audio files, folders or manifests")
+    parser.add_argument("--output", default="transcripts.jsonl", help="JSONL results, appended to")
+    parser.add_argument(
+        "--config",
+        default="default.json",
+        help="Path to JSON config file in the configs folder",
+    )
+    parser.add_argument("--batch-size", type=int, help="Files per model call, default batch_max_size")
+    parser.add_argument("--workers", type=int, default=4, help="Decoding threads")
+    parser.add_argument("--prefetch", type=int, default=32, help="Decoded files kept ahead")
+    parser.add_argument("--timestamps", action="store_true", help="Add segments with timestamps")
+    args = parser.parse_args()
+
+    config = load_config(join("configs", args.config))
+    stt_params = config.get("Stt", {}).get("params", {})
+    batch_size = args.batch_size or stt_params.get("batch_max_size", None) or 8
+
+    done = load_done(args.output)
+    files = [path for path in list_files(args.inputs) if path not in done]
+    print(f"{len(files)} files to transcribe, {len(done)} already done")
+    if not files:
+        sys.exit()
+
+    stt = Stt(params=stt_params)
+    paths = queue.Queue()
+    for path in files:
+        paths.put(path)
+    decoded = queue.Queue(maxsize=args.prefetch)
+    for _ in range(args.workers):
+        threading.Thread(
+            target=decode_files, args=(paths, decoded, stt.samplerate), daemon=True
+        ).start()
+
+    start = time.perf_counter()
+    audio_sec = 0
+    n_files = 0
+    running = args.workers
+    batch = []
+    with open(args.output, "a") as file:
+        while running > 0:
+            item = decoded.get()
+            if item is None:
+                running -= 1
+            else:
+                path, audio, error = item
+                if error is not None:
+                    print(f"{path}: {error}")
+                    file.write(json.dumps({"path": path, "error": error}) + "\n")
+                    continue
+                batch.append((path, audio))
+            if len(batch) == batch_size or (running == 0 and batch):
+                write_results(file, stt, batch, args.timestamps)
+                n_files += len(batch)
+                audio_sec += sum(len(audio) for _, audio in batch) / stt.samplerate
+                batch = []
+                elapsed = time.perf_counter() - start
+                print(
+                    f"{n_files}/{len(files)} files, {audio_sec / 3600:.2f} h of audio,"
+                    f" {audio_sec / elapsed:.1f} audio hours per hour"
+                )